@@ -1,10 +1,12 @@
 from func.minion.modules import func_module
 
 import sys
-import time
 
 sys.path.append('/home/marko/Projects/opennode/opennode-tui')
 
+# read once per minion process
+_main_iface = None
+
 
 class OpenNode(func_module.FuncModule):
     version = "0.0.1"
@@ -12,44 +14,37 @@ class OpenNode(func_module.FuncModule):
     description = "opennode module"
 
     def metrics(self):
-        from opennode.cli.actions.utils import execute, roll_data
+        from opennode.cli.actions import sysresources as sysres
+        from opennode.cli.actions.timeseries import store
         from opennode.cli import config
 
+        window = config.cget('general', 'metrics-window')
+        window = float(window) if window else None
+
         def cpu_usage():
-            time_list_now = map(int, execute("head -n 1 /proc/stat").split(' ')[2:6])
-            time_list_was = roll_data('/tmp/func-cpu-host', time_list_now, [0] * 6)
-            deltas = [yi - xi for yi, xi in zip(time_list_now, time_list_was)]
+            store.add('host', 'cpu', sysres.get_cpu_times())
+            delta = store.delta('host', 'cpu', window)
+            if delta is None:
+                return 0
+            deltas = delta[1]
             try:
                 cpu_pct = 1 - (float(deltas[-1]) / sum(deltas))
             except ZeroDivisionError:
                 cpu_pct = 0
             return cpu_pct
 
-        def load():
-            return float(execute("cat /proc/loadavg | awk '{print $1}'"))
-
-        def memory_usage():
-            return float(execute("free | tail -n 2 | head -n 1 |awk '{print $3 / 1024}'"))
-
         def network_usage():
-            def get_netstats():
-                iface = config.c('general', 'main_iface')
-                return [int(v) for v in \
-                        execute("grep %s: /proc/net/dev | awk -F: '{print $2}' | awk '{print $1, $9}'" % iface).split(' ')]
+            global _main_iface
+            if _main_iface is None:
+                _main_iface = config.c('general', 'main_iface')
             try:
-                t2, (rx2, tx2) = time.time(), get_netstats()
-                t1, rx1, tx1 = roll_data("/tmp/func-network-host", (t2, rx2, tx2), (0, 0, 0))
-
-                window = t2 - t1
-                return ((rx2 - rx1) / window, (tx2 - tx1) / window)
+                store.add('host', 'network', sysres.get_netdev_counters(_main_iface))
+                return store.rates('host', 'network', window) or (0, 0)
             except ValueError:
                 return (0, 0)  # better this way
 
-        def diskspace_usage():
-            return float(execute("df -P |grep ' /$' | head -n 1 | awk '{print $3/1024}'"))
-
         return dict(cpu_usage=cpu_usage(),
-                    load=load(),
-                    memory_usage=memory_usage(),
+                    load=sysres.get_loadavg(),
+                    memory_usage=sysres.get_memory_usage_mb(),
                     network_usage=max(network_usage()),
-                    diskspace_usage=diskspace_usage())
+                    diskspace_usage=sysres.get_diskspace_usage_mb('/'))
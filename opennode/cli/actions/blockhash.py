@@ -0,0 +1,197 @@
+"""
+Block hash manifests of template files.
+
+A manifest holds SHA-256 of every BLOCK_SIZE block of a file and of the file
+as a whole, computed in a single streaming read. It is stored as JSON next
+to the file (<file>.blocks) and allows verifying a file on several cores,
+checking how much of a partial download can be kept and updating a file to a
+new version by fetching only the blocks which changed.
+"""
+
+import hashlib
+import json
+import os
+
+from opennode.cli.actions.utils import atomic_write, run_concurrently, open_url, delete
+
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def compute(fnm, block_size=BLOCK_SIZE):
+    """Return block hash manifest of a file"""
+    whole = hashlib.sha256()
+    blocks = []
+    size = 0
+    with open(fnm, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            whole.update(block)
+            blocks.append(hashlib.sha256(block).hexdigest())
+            size += len(block)
+    return dict(block_size=block_size, size=size, sha256=whole.hexdigest(),
+                blocks=blocks)
+
+
+def manifest_fnm(fnm):
+    return "%s.blocks" % fnm
+
+
+def write(fnm, block_size=BLOCK_SIZE):
+    """Compute block hash manifest of a file and save it as <file>.blocks"""
+    manifest = compute(fnm, block_size)
+    atomic_write(manifest_fnm(fnm), dumps(manifest))
+    return manifest
+
+
+def dumps(manifest):
+    return json.dumps(manifest, sort_keys=True) + '\n'
+
+
+def loads(data):
+    manifest = json.loads(data)
+    for key in ('block_size', 'size', 'blocks'):
+        if key not in manifest:
+            raise ValueError("Block manifest is missing '%s'" % key)
+    return manifest
+
+
+def load(fnm):
+    """Return saved block hash manifest of a file, None if there is none"""
+    try:
+        with open(manifest_fnm(fnm)) as f:
+            return loads(f.read())
+    except (IOError, ValueError):
+        return None
+
+
+def is_current(fnm):
+    """Return True if <file>.blocks exists and is not older than the file"""
+    try:
+        return os.stat(manifest_fnm(fnm)).st_mtime >= os.stat(fnm).st_mtime
+    except OSError:
+        return False
+
+
+def _block_hash(fnm, index, block_size):
+    with open(fnm, 'rb') as f:
+        f.seek(index * block_size)
+        return hashlib.sha256(f.read(block_size)).hexdigest()
+
+
+def bad_blocks(fnm, manifest, workers=None, count=None):
+    """Return sorted indices of blocks of the file not matching the manifest,
+    checking the first `count` blocks (all by default). Blocks are hashed in
+    parallel by `workers` threads (one per CPU by default), hashlib releases
+    the GIL while hashing."""
+    if workers is None:
+        workers = os.sysconf('SC_NPROCESSORS_ONLN')
+    block_size = manifest['block_size']
+    expected = manifest['blocks']
+    if count is not None:
+        expected = expected[:count]
+    results, failures, timed_out = run_concurrently(
+        lambda i: _block_hash(fnm, i, block_size), range(len(expected)), workers)
+    return sorted([i for i, h in enumerate(expected) if results.get(i) != h])
+
+
+def verify(fnm, manifest, workers=None):
+    """Return True if the file matches the manifest"""
+    try:
+        if os.path.getsize(fnm) != manifest['size']:
+            return False
+    except OSError:
+        return False
+    return not bad_blocks(fnm, manifest, workers)
+
+
+def valid_prefix(fnm, manifest, workers=None):
+    """Return length of the leading part of a (partial) file that matches the
+    manifest, in whole blocks, e.g. to resume a download from there"""
+    try:
+        size = os.path.getsize(fnm)
+    except OSError:
+        return 0
+    block_size = manifest['block_size']
+    # only complete blocks can be checked, except for the last one of the file
+    count = size // block_size
+    if size >= manifest['size']:
+        count = len(manifest['blocks'])
+    bad = bad_blocks(fnm, manifest, workers, count)
+    good = bad[0] if bad else count
+    return min(good * block_size, manifest['size'])
+
+
+def delta_download(remote, local, manifest, hook=None, timeout=60, limiter=None):
+    """
+    Turn the local file into the version described by the manifest of the
+    remote file. Blocks found in the local file (at any block boundary) are
+    copied, the rest is fetched with HTTP Range requests, one per run of
+    consecutive missing blocks. The result is verified before it replaces
+    the local file. Return the number of bytes fetched.
+
+    Raise IOError if the server doesn't support ranges or the result doesn't
+    match the manifest.
+    """
+    block_size = manifest['block_size']
+    current = load(local) if is_current(local) else None
+    if current is None or current['block_size'] != block_size:
+        current = write(local, block_size)
+    have = {}
+    for i, block_hash in enumerate(current['blocks']):
+        have.setdefault(block_hash, i)
+
+    blocks = manifest['blocks']
+    partfile = "%s.delta" % local
+    fetched = 0
+    try:
+        with open(local, 'rb') as src:
+            with open(partfile, 'wb') as dst:
+                i = 0
+                while i < len(blocks):
+                    if blocks[i] in have:
+                        src.seek(have[blocks[i]] * block_size)
+                        dst.write(src.read(block_size))
+                        i += 1
+                    else:
+                        last = i
+                        while last + 1 < len(blocks) and blocks[last + 1] not in have:
+                            last += 1
+                        fetched += _fetch_range(remote, dst, i * block_size,
+                                                min((last + 1) * block_size, manifest['size']),
+                                                timeout, limiter)
+                        i = last + 1
+                    if hook is not None:
+                        hook(1, dst.tell(), manifest['size'])
+        if not verify(partfile, manifest):
+            raise IOError("Delta of %s doesn't match its block manifest" % remote)
+        os.rename(partfile, local)
+    except:
+        delete(partfile)
+        raise
+    atomic_write(manifest_fnm(local), dumps(manifest))
+    return fetched
+
+
+def _fetch_range(remote, dst, start, end, timeout, limiter=None):
+    """Append bytes start..end-1 of a remote file to dst"""
+    response = open_url(remote, {'Range': 'bytes=%s-%s' % (start, end - 1)}, timeout)
+    try:
+        content_range = response.info().get('Content-Range', '')
+        if response.getcode() != 206 or \
+                not content_range.split(' ')[-1].startswith('%s-%s/' % (start, end - 1)):
+            raise IOError("Server doesn't support range requests for %s" % remote)
+        length = end - start
+        while length > 0:
+            data = response.read(min(length, 64 * 1024))
+            if not data:
+                raise IOError("Connection closed while fetching %s" % remote)
+            dst.write(data)
+            length -= len(data)
+            if limiter is not None:
+                limiter.consume(len(data))
+        return end - start
+    finally:
+        response.close()
@@ -0,0 +1,122 @@
+"""
+Persistent catalog of templates in a storage pool.
+
+Template names of a folder are cached together with the folder's mtime, and
+parsed template settings together with size and mtime of the OVF file, in an
+SQLite database at the root of the storage pool. Anything that changed on
+disk is re-read on access, so listing templates costs a few stat calls and a
+single query.
+"""
+
+import os
+import sqlite3
+import time
+import cPickle as pickle
+
+from opennode.cli.actions.utils import MTIME_GRACE
+
+
+CATALOG_NAME = '.templates.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS folders (
+    path TEXT PRIMARY KEY,
+    mtime REAL,
+    names TEXT
+);
+CREATE TABLE IF NOT EXISTS templates (
+    ovf_path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    signature TEXT,
+    settings BLOB
+);
+"""
+
+
+class TemplateCatalog(object):
+
+    def __init__(self, fnm):
+        self.fnm = fnm
+
+    def _connect(self):
+        conn = sqlite3.connect(self.fnm, timeout=30)
+        conn.text_factory = str
+        conn.executescript(SCHEMA)
+        return conn
+
+    def list_names(self, folder, scan):
+        """Return names of templates in a folder. scan() is called to list
+        the folder again when it changed since the last call."""
+        mtime = os.stat(folder).st_mtime
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT mtime, names FROM folders WHERE path = ?",
+                               (folder,)).fetchone()
+            if row is not None and row[0] == mtime:
+                return [name for name in row[1].split('\n') if name]
+            names = scan()
+            with conn:
+                if time.time() - mtime > MTIME_GRACE:
+                    conn.execute("INSERT OR REPLACE INTO folders VALUES (?, ?, ?)",
+                                 (folder, mtime, '\n'.join(names)))
+                # forget settings of templates which are gone. Paths below the
+                # folder sort between '<folder>/' and '<folder>0' ('/' + 1), a
+                # range compares them exactly, unlike LIKE with its wildcards
+                # and case folding
+                conn.execute("DELETE FROM templates WHERE ovf_path >= ? AND ovf_path < ? "
+                             "AND ovf_path NOT IN (%s)" % ','.join('?' * len(names)),
+                             [os.path.join(folder, ''), folder.rstrip('/') + '0'] +
+                             [os.path.join(folder, 'unpacked', "%s.ovf" % n) for n in names])
+            return names
+        finally:
+            conn.close()
+
+    def get_settings(self, ovf_paths, parse, signature=''):
+        """Return a list of settings of the templates given by OVF file paths.
+        parse(ovf_path) is called for templates which are not in the catalog
+        yet or which changed since, as well as when the signature (e.g. of the
+        defaults configuration) differs from the one they were parsed with."""
+        conn = self._connect()
+        try:
+            cached = {}
+            for row in conn.execute("SELECT ovf_path, size, mtime, signature, settings FROM templates"):
+                cached[row[0]] = row[1:]
+            res = []
+            updates = []
+            now = time.time()
+            for ovf_path in ovf_paths:
+                st = os.stat(ovf_path)
+                row = cached.get(ovf_path)
+                if row is not None and row[:3] == (st.st_size, st.st_mtime, signature):
+                    res.append(pickle.loads(str(row[3])))
+                    continue
+                settings = parse(ovf_path)
+                res.append(settings)
+                if now - st.st_mtime > MTIME_GRACE:
+                    updates.append((ovf_path, st.st_size, st.st_mtime, signature,
+                                    sqlite3.Binary(pickle.dumps(settings, pickle.HIGHEST_PROTOCOL))))
+            if updates:
+                with conn:
+                    conn.executemany("INSERT OR REPLACE INTO templates VALUES (?, ?, ?, ?, ?)",
+                                     updates)
+            return res
+        finally:
+            conn.close()
+
+
+_catalogs = {}
+
+
+def get_catalog(storage_pool_path):
+    """Return catalog of a storage pool, None if it can't be used (e.g. the
+    storage pool is read-only)"""
+    fnm = os.path.join(storage_pool_path, CATALOG_NAME)
+    if fnm not in _catalogs:
+        catalog = TemplateCatalog(fnm)
+        try:
+            catalog._connect().close()
+        except sqlite3.Error:
+            catalog = None
+        _catalogs[fnm] = catalog
+    return _catalogs[fnm]
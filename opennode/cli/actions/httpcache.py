@@ -0,0 +1,120 @@
+"""
+Local cache of small remote files, such as template lists and hashes.
+
+Cached copies younger than the TTL are returned without contacting the
+server. Older ones are revalidated with a conditional GET (If-None-Match and
+If-Modified-Since), so an unchanged file costs a 304 response only.
+"""
+
+import hashlib
+import os
+import threading
+import time
+import urllib2
+import cPickle as pickle
+
+from opennode.cli import config
+from opennode.cli.actions.utils import open_url, atomic_write, mkdir_p
+
+
+DEFAULT_CACHE_DIR = '/var/cache/opennode/metadata'
+DEFAULT_TTL = 300
+
+# url -> {'etag', 'last_modified', 'fetched', 'body'}
+_entries = {}
+_lock = threading.Lock()
+
+
+def _cache_dir():
+    return config.cget('general', 'metadata-cache-dir', DEFAULT_CACHE_DIR)
+
+
+def _entry_fnm(url):
+    # URLs might carry credentials, only a digest of them ends up on disk
+    return os.path.join(_cache_dir(), hashlib.sha1(url).hexdigest())
+
+
+def _load(url):
+    with _lock:
+        entry = _entries.get(url)
+    if entry is not None:
+        return entry
+    try:
+        with open(_entry_fnm(url), 'rb') as f:
+            entry = pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return None
+    with _lock:
+        _entries[url] = entry
+    return entry
+
+
+def _store(url, entry):
+    with _lock:
+        _entries[url] = entry
+    try:
+        mkdir_p(_cache_dir())
+        atomic_write(_entry_fnm(url), pickle.dumps(entry, pickle.HIGHEST_PROTOCOL))
+    except (IOError, OSError):
+        # an unwritable cache folder leaves us with the in-memory cache only
+        pass
+
+
+def fetch(url, ttl=None, missing_ok=False):
+    """Return contents of a remote file, from the cache if it is younger than
+    `ttl` seconds (metadata-cache-ttl setting by default) or not modified on
+    the server. ttl=0 always revalidates. With missing_ok, a missing file
+    (HTTP 404) is returned as None and remembered for the TTL as well."""
+    if ttl is None:
+        ttl = float(config.cget('general', 'metadata-cache-ttl', DEFAULT_TTL))
+    entry = _load(url)
+    now = time.time()
+    if entry is not None and 0 <= now - entry['fetched'] < ttl:
+        if entry['body'] is not None or missing_ok:
+            return entry['body']
+    headers = {}
+    if entry is not None:
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+    try:
+        response = open_url(url, headers)
+    except urllib2.HTTPError, e:
+        if e.code == 404 and missing_ok:
+            _store(url, dict(etag=None, last_modified=None, fetched=now, body=None))
+            return None
+        if e.code != 304 or entry is None or entry['body'] is None:
+            raise
+        entry = dict(entry, fetched=now)
+        _store(url, entry)
+        return entry['body']
+    try:
+        info = response.info()
+        entry = dict(etag=info.get('ETag'),
+                     last_modified=info.get('Last-Modified'),
+                     fetched=now,
+                     body=response.read())
+    finally:
+        response.close()
+    _store(url, entry)
+    return entry['body']
+
+
+def invalidate(url=None):
+    """Drop a cached URL, or all of them"""
+    with _lock:
+        urls = [url] if url is not None else _entries.keys()
+        for u in urls:
+            _entries.pop(u, None)
+    if url is None:
+        try:
+            for fnm in os.listdir(_cache_dir()):
+                os.unlink(os.path.join(_cache_dir(), fnm))
+        except OSError:
+            pass
+    else:
+        try:
+            os.unlink(_entry_fnm(url))
+        except OSError:
+            pass
@@ -0,0 +1,176 @@
+"""
+Peer template cache: serves the storage pools of a node to other nodes.
+
+Templates are published read-only under /<pool>/<vm type>/ in the layout of a
+template repository (templatelist.txt, manifest.json, <name>.tar with its
+.pfff and .blocks hashes), so any repository URL can be pointed to a peer.
+Tarballs are served with Range support, for resumed and delta downloads.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import json
+import os
+import urllib
+import urlparse
+
+from opennode.cli import config
+from opennode.cli.actions.templates import build_manifest, MANIFEST
+
+
+DEFAULT_PORT = 8090
+VM_TYPES = ('openvz', 'kvm')
+# files of a template which can be downloaded by peers
+SERVED_SUFFIXES = ('.tar', '.tar.pfff', '.tar.blocks')
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class TemplateRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    server_version = 'OpenNodeTemplates/1.0'
+    block_size = 64 * 1024
+
+    def do_GET(self):
+        self._serve(True)
+
+    def do_HEAD(self):
+        self._serve(False)
+
+    def _serve(self, with_body):
+        folder, name = self._resolve()
+        if folder is None:
+            return self.send_error(404)
+        if name == 'templatelist.txt':
+            manifest = build_manifest(folder, calculate=False)
+            body = ''.join("%s\n" % n for n in sorted(manifest['templates']))
+            return self._send_data(body, 'text/plain', with_body)
+        if name == MANIFEST:
+            manifest = build_manifest(folder, calculate=False)
+            body = json.dumps(manifest, indent=2, sort_keys=True) + '\n'
+            return self._send_data(body, 'application/json', with_body)
+        if name.endswith(SERVED_SUFFIXES) and not name.startswith('.'):
+            return self._send_file(os.path.join(folder, name), with_body)
+        self.send_error(404)
+
+    def _resolve(self):
+        """Return (folder, file name) of a request path /<pool>/<vm type>/<file>"""
+        path = urllib.unquote(urlparse.urlsplit(self.path).path)
+        parts = [p for p in path.split('/') if p]
+        if len(parts) != 3:
+            return None, None
+        pool, vm_type, name = parts
+        if pool.startswith('.') or vm_type not in VM_TYPES:
+            return None, None
+        folder = os.path.join(self.server.storage_endpoint, pool, vm_type)
+        if not os.path.isdir(folder):
+            return None, None
+        return folder, name
+
+    def _not_modified(self, etag):
+        return self.headers.get('If-None-Match') == etag
+
+    def _send_data(self, body, content_type, with_body):
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if self._not_modified(etag):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            return self.end_headers()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def _send_file(self, fnm, with_body):
+        try:
+            f = open(fnm, 'rb')
+        except IOError:
+            return self.send_error(404)
+        try:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            etag = '"%x-%x"' % (size, int(st.st_mtime))
+            if self._not_modified(etag):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                return self.end_headers()
+            byte_range = _parse_range(self.headers.get('Range'), size)
+            if byte_range is False:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%s' % size)
+                self.send_header('Content-Length', '0')
+                return self.end_headers()
+            if byte_range is None:
+                start, end = 0, size - 1
+                self.send_response(200)
+            else:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, size))
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', self.date_time_string(st.st_mtime))
+            self.end_headers()
+            if with_body:
+                f.seek(start)
+                _copy(f, self.wfile, end - start + 1, self.block_size)
+        finally:
+            f.close()
+
+
+def _parse_range(header, size):
+    """Return (start, end) of a single byte range request, None if the whole
+    file is to be sent or False if the range cannot be satisfied"""
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start, sep, end = header[len('bytes='):].strip().partition('-')
+    try:
+        if not start:
+            # suffix range, the last <end> bytes
+            start, end = max(0, size - int(end)), size - 1
+        else:
+            start, end = int(start), int(end) if end else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+def _copy(src, dst, length, block_size):
+    while length > 0:
+        data = src.read(min(block_size, length))
+        if not data:
+            break
+        dst.write(data)
+        length -= len(data)
+
+
+def get_server(port=None, address=None):
+    """Return an HTTP server publishing the storage pools of this node"""
+    if port is None:
+        port = int(config.cget('general', 'peer-port', DEFAULT_PORT))
+    if address is None:
+        address = config.cget('general', 'peer-address', '')
+    server = _ThreadingHTTPServer((address, port), TemplateRequestHandler)
+    server.storage_endpoint = config.c('general', 'storage-endpoint')
+    return server
+
+
+def serve(port=None, address=None):
+    """Publish the storage pools of this node to peers until interrupted"""
+    server = get_server(port, address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,325 @@
+"""
+Durable queue of template synchronisation jobs.
+
+Jobs are kept in an append-only journal of JSON records. Every access holds
+a flock on <journal>.lock, so several worker processes can claim jobs and
+record progress while new jobs are enqueued and status is read by the TUI or
+the func module. The state is rebuilt by replaying the journal, which is
+compacted to a snapshot once it grows large.
+"""
+
+import fcntl
+import json
+import os
+import sys
+import subprocess
+import time
+
+from opennode.cli import config
+from opennode.cli.actions.utils import atomic_write, mkdir_p, is_process_alive
+
+
+COMPACT_SIZE = 256 * 1024
+# finished jobs are dropped on compaction after this many seconds
+KEEP_FINISHED = 24 * 3600
+PROGRESS_INTERVAL = 1.0
+# how long the number of running jobs sharing a rate limit is cached
+RUNNING_JOBS_TTL = 10.0
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+
+class SyncQueue(object):
+
+    def __init__(self, fnm):
+        self.fnm = fnm
+        self.lock_fnm = "%s.lock" % fnm
+        self._running = (0, [])
+
+    def _lock(self, exclusive=True):
+        mkdir_p(os.path.dirname(os.path.abspath(self.fnm)))
+        fd = os.open(self.lock_fnm, os.O_RDWR | os.O_CREAT, 0644)
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        return fd
+
+    def _replay(self):
+        """Return (jobs, workers): jobs by id and pids of registered workers"""
+        jobs, workers = {}, set()
+        try:
+            f = open(self.fnm)
+        except IOError:
+            return jobs, workers
+        with f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                    op = rec.pop('op')
+                except (ValueError, KeyError, AttributeError):
+                    # torn record of a crashed writer, or not a journal at all
+                    continue
+                if op == 'add':
+                    jobs[rec['id']] = rec
+                elif op == 'worker':
+                    workers.add(rec['pid'])
+                elif op == 'exit':
+                    workers.discard(rec['pid'])
+                elif op == 'update' and rec.get('id') in jobs:
+                    jobs[rec['id']].update(rec)
+        for job in jobs.values():
+            if job['state'] == RUNNING and not is_process_alive(job['pid']):
+                # worker died, the job will be picked up again
+                job['state'] = QUEUED
+        return jobs, workers
+
+    def _append(self, *records):
+        with open(self.fnm, 'a+b') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != '\n':
+                    # terminate a record torn by a crash
+                    f.write('\n')
+            for rec in records:
+                f.write(json.dumps(rec) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _update(self, job_id, **fields):
+        fields.update(op='update', id=job_id, time=time.time())
+        self._append(fields)
+
+    def _compact(self, jobs, workers):
+        now = time.time()
+        records = [dict(op='worker', pid=pid) for pid in workers if is_process_alive(pid)]
+        for job_id in sorted(jobs):
+            job = jobs[job_id]
+            if job['state'] in (DONE, FAILED) and now - job['time'] > KEEP_FINISHED:
+                continue
+            records.append(dict(job, op='add'))
+        atomic_write(self.fnm, ''.join(json.dumps(rec) + '\n' for rec in records))
+
+    def _compact_if_needed(self, jobs=None, workers=None):
+        """Rewrite the journal once it grows past COMPACT_SIZE, progress
+        records of long downloads would make every replay slower otherwise"""
+        try:
+            if os.path.getsize(self.fnm) <= COMPACT_SIZE:
+                return
+        except OSError:
+            return
+        if jobs is None:
+            jobs, workers = self._replay()
+        self._compact(jobs, workers)
+
+    def enqueue(self, tasks):
+        """Add (template, storage_pool, remote_repo) tasks to the queue, unless
+        they are already waiting or running. Return ids of the new jobs."""
+        fd = self._lock()
+        try:
+            jobs, workers = self._replay()
+            self._compact_if_needed(jobs, workers)
+            pending = set((j['template'], j['storage_pool'], j['remote_repo'])
+                          for j in jobs.values() if j['state'] in (QUEUED, RUNNING))
+            next_id = max([0] + jobs.keys()) + 1
+            records = []
+            for template, storage_pool, remote_repo in tasks:
+                if (template, storage_pool, remote_repo) in pending:
+                    continue
+                pending.add((template, storage_pool, remote_repo))
+                records.append(dict(op='add', id=next_id, template=template,
+                                    storage_pool=storage_pool, remote_repo=remote_repo,
+                                    state=QUEUED, pid=None, done=0, total=None,
+                                    rate=None, error=None, time=time.time()))
+                next_id += 1
+            if records:
+                self._append(*records)
+            return [rec['id'] for rec in records]
+        finally:
+            os.close(fd)
+
+    def claim(self, pid):
+        """Mark the oldest waiting job as running in the worker process pid and
+        return it. If there is nothing to do the worker is unregistered, in
+        the same locked section, and None is returned: start_workers counts
+        registered workers, so a job enqueued meanwhile is never left behind
+        with a worker that is about to exit."""
+        fd = self._lock()
+        try:
+            jobs, workers = self._replay()
+            for job_id in sorted(jobs):
+                job = jobs[job_id]
+                if job['state'] == QUEUED:
+                    job.update(state=RUNNING, pid=pid, error=None, time=time.time())
+                    self._update(job_id, state=RUNNING, pid=pid, error=None)
+                    self._compact_if_needed(jobs, workers)
+                    return job
+            self._append(dict(op='exit', pid=pid))
+        finally:
+            os.close(fd)
+
+    def progress(self, job_id, done, total=None, rate=None):
+        fd = self._lock()
+        try:
+            self._update(job_id, done=done, total=total, rate=rate)
+            self._compact_if_needed()
+        finally:
+            os.close(fd)
+
+    def finish(self, job_id, error=None, **progress):
+        fd = self._lock()
+        try:
+            self._update(job_id, state=FAILED if error else DONE, error=error, **progress)
+            self._compact_if_needed()
+        finally:
+            os.close(fd)
+
+    def register_worker(self, pid):
+        fd = self._lock()
+        try:
+            self._append(dict(op='worker', pid=pid))
+        finally:
+            os.close(fd)
+
+    def unregister_worker(self, pid):
+        fd = self._lock()
+        try:
+            self._append(dict(op='exit', pid=pid))
+        finally:
+            os.close(fd)
+
+    def status(self):
+        """Return (jobs, workers): jobs as a list of dictionaries with id,
+        template, storage_pool, remote_repo, state, pid, done, total (bytes),
+        rate (bytes per second), error and time of the last change; pids of
+        live workers"""
+        fd = self._lock(exclusive=False)
+        try:
+            jobs, workers = self._replay()
+        finally:
+            os.close(fd)
+        return ([jobs[job_id] for job_id in sorted(jobs)],
+                [pid for pid in workers if is_process_alive(pid)])
+
+    def running_jobs(self, remote_repo=None):
+        """Return the number of running jobs, of a repository if given. The
+        running jobs are looked up at most every RUNNING_JOBS_TTL seconds."""
+        checked, running = self._running
+        now = time.time()
+        if not checked <= now < checked + RUNNING_JOBS_TTL:
+            running = [job['remote_repo'] for job in self.status()[0]
+                       if job['state'] == RUNNING]
+            self._running = (now, running)
+        if remote_repo is None:
+            return len(running)
+        return running.count(remote_repo)
+
+    def is_active(self):
+        """Return True if any job is waiting or running"""
+        return any(job['state'] in (QUEUED, RUNNING) for job in self.status()[0])
+
+    def start_workers(self, count):
+        """Start detached worker processes, up to count workers in total but
+        not more than there are jobs waiting"""
+        jobs, workers = self.status()
+        waiting = len([job for job in jobs if job['state'] == QUEUED])
+        code = "from opennode.cli.actions import syncqueue; syncqueue.run_worker(%r)" % self.fnm
+        for i in range(max(0, min(count, waiting) - len(workers))):
+            # the intermediate shell exits at once, leaving the worker to init
+            subprocess.Popen(['/bin/sh', '-c', 'setsid "$0" -c "$1" >>"$2" 2>&1 </dev/null &',
+                              sys.executable, code, "%s.log" % self.fnm]).wait()
+
+
+def get_queue(fnm=None):
+    if fnm is None:
+        fnm = config.c('general', 'sync_task_list')
+    return SyncQueue(fnm)
+
+
+def _parse_window(window):
+    """Parse HH:MM-HH:MM into a pair of minutes since midnight"""
+    try:
+        times = [map(int, t.split(':')) for t in window.split('-')]
+        (start_h, start_m), (end_h, end_m) = times
+    except ValueError:
+        raise ValueError("Invalid sync-window '%s', expected HH:MM-HH:MM" % window)
+    for hours, minutes in times:
+        if not (0 <= hours < 24 and 0 <= minutes < 60):
+            raise ValueError("Invalid sync-window '%s', expected HH:MM-HH:MM" % window)
+    return start_h * 60 + start_m, end_h * 60 + end_m
+
+
+def seconds_to_window(window=None, now=None):
+    """Return seconds until the sync-window setting (e.g. 22:00-06:00) opens,
+    0 if the window is open or no window is set"""
+    if window is None:
+        window = config.cget('general', 'sync-window', '')
+    if not window.strip():
+        return 0
+    start, end = _parse_window(window.strip())
+    now = time.localtime(now)
+    minute = now.tm_hour * 60 + now.tm_min
+    if start <= end:
+        is_open = start <= minute < end
+    else:
+        # the window spans midnight
+        is_open = minute >= start or minute < end
+    if is_open:
+        return 0
+    return ((start - minute) % (24 * 60)) * 60 - now.tm_sec
+
+
+def _wait_for_window():
+    while True:
+        try:
+            wait = seconds_to_window()
+        except ValueError, e:
+            # a broken setting doesn't hold up the queue
+            print >>sys.stderr, "%s, ignoring it" % e
+            return
+        if wait <= 0:
+            return
+        # re-check every minute, the setting may change meanwhile
+        time.sleep(min(wait, 60))
+
+
+def run_worker(fnm=None):
+    """Process queued jobs until there are none left. Jobs are only started
+    within the sync-window, a running job is always finished."""
+    from opennode.cli.actions import templates
+    queue = get_queue(fnm)
+    pid = os.getpid()
+    queue.register_worker(pid)
+    registered = True
+    try:
+        while True:
+            _wait_for_window()
+            job = queue.claim(pid)
+            if job is None:
+                # claim has unregistered the worker
+                registered = False
+                return
+            started = time.time()
+            # bytes are counted by the limiter, resumed downloads and unchanged
+            # blocks of a delta sync don't count towards the throughput
+            limiter = templates.get_rate_limiter(job['remote_repo'], queue.running_jobs)
+            # time and transferred bytes of the last journaled update, bytes done, total bytes
+            progress = [started, 0, 0, job['total']]
+
+            def hook(count, blockSize, totalSize):
+                progress[2:] = [count * blockSize, totalSize if totalSize > 0 else None]
+                now = time.time()
+                if now - progress[0] >= PROGRESS_INTERVAL:
+                    rate = (limiter.consumed - progress[1]) / (now - progress[0])
+                    progress[:2] = [now, limiter.consumed]
+                    queue.progress(job['id'], progress[2], progress[3], rate)
+            try:
+                templates.sync_template(job['remote_repo'], job['template'],
+                                        job['storage_pool'], hook, limiter)
+                error = None
+            except Exception, e:
+                error = str(e) or e.__class__.__name__
+            # average throughput of the whole job
+            rate = limiter.consumed / max(time.time() - started, 0.001)
+            queue.finish(job['id'], error, done=progress[2], total=progress[3], rate=rate)
+    finally:
+        if registered:
+            queue.unregister_worker(pid)
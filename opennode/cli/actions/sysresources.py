@@ -1,12 +1,88 @@
-import re
+import os
+import threading
 
 from opennode.cli.actions.utils import execute
 
 
+class ProcFile(object):
+    """A /proc file kept open between reads. Every read() returns the current
+    contents, as the kernel regenerates them when reading from offset 0."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self._lock = threading.Lock()
+
+    def read(self):
+        with self._lock:
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_RDONLY)
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            chunks = []
+            while True:
+                chunk = os.read(self.fd, 65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            return ''.join(chunks)
+
+
+_proc_files = {}
+
+
+def read_proc(path):
+    """Return contents of a /proc file, reusing an open file handle"""
+    proc_file = _proc_files.get(path)
+    if proc_file is None:
+        proc_file = _proc_files.setdefault(path, ProcFile(path))
+    return proc_file.read()
+
+
+def get_cpu_times():
+    """Return aggregate (user, nice, system, idle) CPU times in jiffies"""
+    return map(int, read_proc('/proc/stat').split('\n', 1)[0].split()[1:5])
+
+
+def get_loadavg():
+    """Return 1 minute load average"""
+    return float(read_proc('/proc/loadavg').split()[0])
+
+
+def get_meminfo():
+    """Return /proc/meminfo as a dictionary of values in KB"""
+    res = {}
+    for line in read_proc('/proc/meminfo').splitlines():
+        cols = line.split()
+        if len(cols) >= 2:
+            res[cols[0].rstrip(':')] = int(cols[1])
+    return res
+
+
+def get_memory_usage_mb():
+    """Return memory used by processes (without buffers and cache) in MB"""
+    mi = get_meminfo()
+    return (mi['MemTotal'] - mi['MemFree'] - mi.get('Buffers', 0) - mi.get('Cached', 0)) / 1024.0
+
+
+def get_netdev_counters(iface):
+    """Return (received, transmitted) bytes of a network interface"""
+    for line in read_proc('/proc/net/dev').splitlines():
+        name, sep, counters = line.partition(':')
+        if sep and name.strip() == iface:
+            cols = counters.split()
+            return int(cols[0]), int(cols[8])
+    raise ValueError("Network interface '%s' not found" % iface)
+
+
+def get_diskspace_usage_mb(path='/'):
+    """Return used space of the filesystem in MB, as reported by df"""
+    st = os.statvfs(path)
+    return (st.f_blocks - st.f_bfree) * st.f_frsize / 1024.0 ** 2
+
+
 def get_cpu_count():
-    output = execute("cat /proc/cpuinfo | grep processor")
-    cpu_count = len(output.split("\n"))
-    return cpu_count
+    return len([line for line in read_proc('/proc/cpuinfo').splitlines()
+                if line.startswith('processor')])
 
 
 def get_cpu_usage_limit():
@@ -14,36 +90,30 @@ def get_cpu_usage_limit():
 
 
 def get_ram_size_gb():
-    cmd_list = ["cat /proc/meminfo | grep MemFree",
-                "cat /proc/meminfo | grep Buffers",
-                "cat /proc/meminfo | grep Cached"]
-    memory = 0
-    for cmd in cmd_list:
-        output = execute(cmd)
-        try:
-            memory += int(output.split()[1])
-        except (ValueError, IndexError):
-            raise RuntimeError("Unable to calculate OpenNode server memory size")
+    meminfo = get_meminfo()
+    try:
+        memory = meminfo['MemFree'] + meminfo['Buffers'] + meminfo['Cached']
+    except KeyError:
+        raise RuntimeError("Unable to calculate OpenNode server memory size")
     return round(memory / 1024.0 ** 2, 3)
 
 
 def get_swap_size_gb():
     total_swap = 0
-    output = execute("swapon -s")
-    for dev_line in output.split("\n")[1:]:
-        size, used = map(int, re.split("\s+", dev_line)[2:4])
+    # Filename Type Size Used Priority, the same as swapon -s
+    for dev_line in read_proc('/proc/swaps').splitlines()[1:]:
+        size, used = map(int, dev_line.split()[2:4])
         total_swap += (size - used)
     return round(total_swap / 1024.0 ** 2, 3)
 
 
-def get_disc_space_gb():
-    output = execute("df /vz")
-    tmp_output = output.split("\n", 1)
-    if len(tmp_output) != 2:
+def get_disc_space_gb(path='/vz'):
+    try:
+        st = os.statvfs(path)
+    except OSError:
         raise RuntimeError("Unable to calculate disk space")
-    df_list = tmp_output[1].split()
-    disk_space = float(df_list[3])
-    return round(disk_space / 1024 ** 2, 3)
+    # space available to unprivileged users, as reported by df
+    return round(st.f_bavail * st.f_frsize / 1024.0 ** 3, 3)
 
 
 def get_min_disc_space_gb(vm_id):
@@ -1,22 +1,32 @@
 import tarfile
 import os
+import hashlib
+import json
 import shutil
 import re
-import cPickle as pickle
+import socket
+import httplib
+import threading
+import time
 
 from ovf.OvfFile import OvfFile
 
 from opennode.cli.config import c
-from opennode.cli.actions.utils import delete, calculate_hash, execute_in_screen, \
-                                execute, download, urlopen, TemplateException
-from opennode.cli.actions import storage, vm as vm_ops
+from opennode.cli.actions.utils import delete, calculate_hash, download, \
+                                TemplateException, atomic_write, get_hash, open_url, \
+                                TokenBucket, parse_size
+from opennode.cli.actions import storage, httpcache, blockhash, catalog, syncqueue, \
+                                vm as vm_ops
 from opennode.cli import config
 
 
 __all__ = ['get_template_repos', 'get_template_list', 'sync_storage_pool',
            'sync_template', 'delete_template', 'unpack_template',
            'get_local_templates', 'sync_oms_template', 'is_fresh',
-           'is_syncing']
+           'is_syncing', 'get_templates_sync_progress', 'get_sync_status',
+           'generate_manifest', 'get_template_index', 'get_mirrors']
+
+MANIFEST = 'manifest.json'
 
 
 def _simple_download_hook(count, blockSize, totalSize):
@@ -40,17 +50,68 @@ def get_template_repos():
 def get_template_list(remote_repo):
     """Retrieves a tmpl_list of templates from the specified repository"""
     url = c(remote_repo, 'url')
-    tmpl_list = urlopen("%s/templatelist.txt" % url)
-    templates = [template.strip() for template in tmpl_list]
-    tmpl_list.close()
-    return templates
+    manifest = get_manifest(url)
+    if manifest is not None:
+        return sorted(str(name) for name in manifest['templates'])
+    tmpl_list = httpcache.fetch("%s/templatelist.txt" % url)
+    return [template.strip() for template in tmpl_list.splitlines()]
+
+
+def get_manifest(url, ttl=None):
+    """Return manifest of a repository, None if the repository has none.
+    Manifest is a dictionary of templates: {name: {size, hash, mtime, type}}"""
+    manifest = httpcache.fetch("%s/%s" % (url.rstrip('/'), MANIFEST), ttl, missing_ok=True)
+    if manifest is None:
+        return None
+    try:
+        return json.loads(manifest)
+    except ValueError:
+        raise TemplateException("Malformed template manifest in %s" % url)
+
+
+def build_manifest(directory, vm_type=None, calculate=True):
+    """Return manifest of all templates (<name>.tar files) of a folder.
+    Missing or outdated .pfff and .blocks hashes are calculated, unless
+    calculate is False, in which case templates without a .pfff are left out."""
+    if vm_type is None:
+        vm_type = os.path.basename(os.path.normpath(directory))
+    templates = {}
+    for fnm in sorted(os.listdir(directory)):
+        if not fnm.endswith('.tar'):
+            continue
+        tarfnm = os.path.join(directory, fnm)
+        if calculate:
+            calculate_hash(tarfnm)
+        elif not os.path.exists("%s.pfff" % tarfnm):
+            continue
+        with open("%s.pfff" % tarfnm) as f:
+            tmpl_hash = f.read()
+        st = os.stat(tarfnm)
+        blocks = blockhash.load(tarfnm)
+        templates[fnm[:-4]] = dict(size=st.st_size, hash=tmpl_hash,
+                                   sha256=blocks['sha256'] if blocks else None,
+                                   mtime=int(st.st_mtime), type=vm_type)
+    return dict(version=1, templates=templates)
+
+
+def generate_manifest(directory, vm_type=None):
+    """Write manifest.json describing all templates (<name>.tar files) of a
+    folder, e.g. a storage pool folder to be published as a repository.
+    Missing or outdated .pfff and .blocks hashes are calculated."""
+    manifest = build_manifest(directory, vm_type)
+    atomic_write(os.path.join(directory, MANIFEST),
+                 json.dumps(manifest, indent=2, sort_keys=True) + '\n')
+    return manifest
 
 
 def sync_storage_pool(storage_pool, remote_repo, templates,
                       sync_tasks_fnm=c('general', 'sync_task_list'), force=False):
     """Synchronize selected storage pool with the remote repo. Only selected templates
     will be persisted, all of the other templates shall be purged.
-    Ignores purely local templates - templates with no matching name in remote repo."""
+    Ignores purely local templates - templates with no matching name in remote repo.
+    Templates are downloaded by background workers of the sync queue (up to
+    sync-workers processes), also when a synchronisation is already running.
+    force is ignored and kept for compatibility."""
     vm_type = c(remote_repo, 'type')
     existing_templates = get_local_templates(vm_type, storage_pool)
     # synchronize selected templates
@@ -60,38 +121,316 @@ def sync_storage_pool(storage_pool, remote_repo, templates,
     for_update = set(templates) - set(purely_local_tmpl)
     for_deletion = set(existing_templates) - for_update - set(templates)
 
-    tasks = [(t, storage_pool, remote_repo) for t in for_update]
-    # XXX at the moment only a single sync process is allowed.
-    if os.path.exists(sync_tasks_fnm):
-        if not force:
-            raise TemplateException("Synchronization task pool already defined.")
-    set_templates_sync_list(tasks, sync_tasks_fnm)
     # delete existing, but not selected templates
     for tmpl in for_deletion:
         delete_template(storage_pool, vm_type, tmpl)
-    # XXX a wrong place for such a construction, not sure what is a correct place
-    cli_command = "from opennode.cli.actions import templates;"
-    cli_command += "templates.sync_templates_list('%s')" % sync_tasks_fnm
-    execute_in_screen('OPENNODE-SYNC', 'python -c "%s"' % cli_command)
+    queue = syncqueue.get_queue(sync_tasks_fnm)
+    queue.enqueue([(t, storage_pool, remote_repo) for t in sorted(for_update)])
+    queue.start_workers(int(config.cget('general', 'sync-workers', 1)))
+
+
+def sync_template(remote_repo, template, storage_pool, hook=None, limiter=None):
+    """Synchronizes local template (cache) with the remote one (master).
+    Downloads go through limiter, get_rate_limiter(remote_repo) by default."""
+    tarfnm = os.path.join(c('general', 'storage-endpoint'), storage_pool,
+                          c(remote_repo, 'type'), "%s.tar" % template)
+    # an existing tarball might be updated with a delta instead
+    if _is_streaming() and not (_is_delta_enabled() and os.path.exists(tarfnm)):
+        stream_template(remote_repo, template, storage_pool, hook, limiter=limiter)
+        return
+    fetched = download_template(remote_repo, template, storage_pool, hook, limiter)
+    if fetched is not None:
+        vm_type, localfile = fetched
+        unpack_template(storage_pool, vm_type, localfile)
 
 
-def sync_template(remote_repo, template, storage_pool):
-    """Synchronizes local template (cache) with the remote one (master)"""
+def download_template(remote_repo, template, storage_pool, hook=None, limiter=None):
+    """Download template and its hash unless the local copy is fresh.
+    Return (vm_type, localfile) of a downloaded template or None."""
     url = c(remote_repo, 'url')
     vm_type = c(remote_repo, 'type')
     storage_endpoint = c('general', 'storage-endpoint')
     localfile = os.path.join(storage_endpoint, storage_pool, vm_type, template)
     remotefile = os.path.join(url, template)
-    # only download if we don't already have a fresh copy
-    if not is_fresh(localfile, remotefile):
-        # for resilience
-        storage.prepare_storage_pool(storage_pool)
-        download("%s.tar" % remotefile, "%s.tar" % localfile)
-        for h in ['pfff']:
-            r_template_hash = "%s.tar.%s" % (remotefile, h)
-            l_template_hash = "%s.tar.%s" % (localfile, h)
-            download(r_template_hash, l_template_hash)
-        unpack_template(storage_pool, vm_type, localfile)
+    # only download if we don't already have a fresh copy, the hash is
+    # revalidated as the download is checked against it
+    remote_hash = _get_remote_hash(remotefile, 0)
+    if remote_hash == _get_local_hash(localfile):
+        return None
+    # for resilience
+    storage.prepare_storage_pool(storage_pool)
+
+    blocks = _get_remote_blocks(remotefile)
+    if limiter is None:
+        limiter = get_rate_limiter(remote_repo)
+    sources = _get_sources(remote_repo, template, remote_hash)
+    for i, source in enumerate(sources):
+        try:
+            _fetch_template(os.path.join(source, template), localfile, remote_hash,
+                            blocks, hook, limiter)
+            break
+        except (IOError, socket.error, httplib.HTTPException):
+            # try the next mirror, the repository itself is the last resort
+            if i == len(sources) - 1:
+                raise
+    return vm_type, localfile
+
+
+def _fetch_template(remotefile, localfile, remote_hash, blocks, hook, limiter):
+    """Bring localfile up to date with remotefile, checking it against
+    the block hash manifest or the hash of the repository"""
+    partfile = "%s.tar.part" % localfile
+    if blocks is not None and _is_delta_enabled() and \
+            os.path.exists("%s.tar" % localfile) and not os.path.exists(partfile):
+        try:
+            blockhash.delta_download("%s.tar" % remotefile, "%s.tar" % localfile, blocks,
+                                     hook, limiter=limiter)
+        except (IOError, socket.error, httplib.HTTPException):
+            # fall back to a full download
+            pass
+        else:
+            atomic_write("%s.tar.pfff" % localfile, remote_hash)
+            return
+    if blocks is not None:
+        # keep only the verified part of an interrupted download
+        if os.path.exists(partfile):
+            with open(partfile, 'r+b') as f:
+                f.truncate(blockhash.valid_prefix(partfile, blocks))
+        verify = lambda partfile: blockhash.verify(partfile, blocks)
+    else:
+        def verify(partfile):
+            # pfff output might carry a file name, compare only the hash itself
+            return get_hash(partfile).split()[:1] == remote_hash.split()[:1]
+    download("%s.tar" % remotefile, "%s.tar" % localfile, hook, verify, limiter=limiter)
+    # hashes are stored only after the template itself is in place
+    if blocks is not None:
+        atomic_write(blockhash.manifest_fnm("%s.tar" % localfile), blockhash.dumps(blocks))
+    atomic_write("%s.tar.pfff" % localfile, remote_hash)
+
+
+def _is_streaming():
+    return config.cget('general', 'template-streaming', 'no') == 'yes'
+
+
+def get_rate_limiter(remote_repo, running_jobs=None):
+    """Return a TokenBucket limiting downloads from the repository to its
+    rate-limit setting (bytes per second, e.g. 512K or 2M), or the one in
+    the general section. The setting is re-read every second, so changes
+    apply to running downloads as well.
+    Jobs of the sync queue share the limit: running_jobs(remote_repo) returns
+    the number of running jobs of a repository, running_jobs(None) of all
+    repositories, for the repository and the general limit respectively."""
+    def rate():
+        limit = config.cget(remote_repo, 'rate-limit')
+        shared_by = remote_repo
+        if limit is None:
+            limit = config.cget('general', 'rate-limit', 0)
+            shared_by = None
+        limit = parse_size(limit)
+        if not limit or running_jobs is None:
+            return limit
+        return limit / max(1, running_jobs(shared_by))
+    return TokenBucket(rate)
+
+
+def _is_delta_enabled():
+    return config.cget('general', 'template-delta-sync', 'yes') == 'yes'
+
+
+class _StreamReader(object):
+    """File-like wrapper of a response, hashing everything read through it,
+    optionally copying it to a file and reporting progress to a urllib hook"""
+
+    def __init__(self, fileobj, total=-1, copy=None, hook=None, limiter=None):
+        self.fileobj = fileobj
+        self.total = total
+        self.copy = copy
+        self.hook = hook
+        self.limiter = limiter
+        self.done = 0
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        if self.copy is not None:
+            self.copy.write(data)
+        self.done += len(data)
+        if self.limiter is not None:
+            self.limiter.consume(len(data))
+        if self.hook is not None:
+            self.hook(1, self.done, self.total)
+        return data
+
+    def drain(self, block_size=64 * 1024):
+        """Read the rest of the stream, e.g. padding after the end of archive"""
+        while self.read(block_size):
+            pass
+
+
+def stream_template(remote_repo, template, storage_pool, hook=None, keep_tar=None,
+                    limiter=None):
+    """Download and unpack a template in a single pass, unless the local copy
+    is fresh. Members are extracted while the tarball is being received, into
+    a staging folder which is moved into 'unpacked' once the stream is complete.
+    The original tarball is kept only with keep_tar (template-keep-tar setting
+    by default). The stream is checked against the SHA-256 published in the
+    block hash manifest or the repository manifest, a kept tarball against
+    the repository hash otherwise. Templates which can't be checked either
+    way are downloaded and unpacked in two passes instead.
+    The member index is stored next to the template as <template>.tar.index.
+    Return (vm_type, localfile) of a synchronized template or None."""
+    url = c(remote_repo, 'url')
+    vm_type = c(remote_repo, 'type')
+    basedir = os.path.join(c('general', 'storage-endpoint'), storage_pool, vm_type)
+    localfile = os.path.join(basedir, template)
+    remotefile = os.path.join(url, template)
+    if keep_tar is None:
+        keep_tar = config.cget('general', 'template-keep-tar', 'yes') == 'yes'
+    remote_hash = _get_remote_hash(remotefile, 0)
+    if remote_hash == _get_local_hash(localfile):
+        return None
+    storage.prepare_storage_pool(storage_pool)
+    blocks = _get_remote_blocks(remotefile)
+    if blocks is not None:
+        sha256 = blocks.get('sha256')
+    else:
+        sha256 = _get_remote_sha256(remotefile)
+    if sha256 is None and not keep_tar:
+        fetched = download_template(remote_repo, template, storage_pool, hook, limiter)
+        if fetched is not None:
+            unpack_template(storage_pool, vm_type, template)
+        return fetched
+
+    tarfnm = "%s.tar" % localfile
+    staging = os.path.join(basedir, 'unpacked', '.%s.partial' % template)
+    if os.path.isdir(staging):
+        shutil.rmtree(staging)
+    response = _open_source(_get_sources(remote_repo, template, remote_hash), template)
+    copy = open("%s.part" % tarfnm, 'wb') if keep_tar else None
+    try:
+        total = int(response.info().get('Content-Length') or -1)
+        if limiter is None:
+            limiter = get_rate_limiter(remote_repo)
+        stream = _StreamReader(response, total, copy, hook, limiter)
+        tmpl = tarfile.open(fileobj=stream, mode='r|')
+        members = []
+        for member in tmpl:
+            # checked before extraction, nothing may end up outside of staging
+            name = _member_name(member, template)
+            if name is None:
+                continue
+            member.name = name
+            tmpl.extract(member, staging)
+            members.append(member)
+        tmpl.close()
+        stream.drain()
+        if total >= 0 and stream.done != total:
+            raise TemplateException("Connection closed after %s of %s bytes of %s" %
+                                    (stream.done, total, template))
+        if sha256 is not None:
+            if stream.digest.hexdigest() != sha256:
+                raise TemplateException("Downloaded template %s doesn't match its hash" % template)
+        else:
+            copy.close()
+            # pfff samples the whole file, the kept tarball is checked instead of the stream
+            if get_hash(copy.name).split()[:1] != remote_hash.split()[:1]:
+                raise TemplateException("Downloaded template %s doesn't match its hash" % template)
+        if copy is not None:
+            copy.close()
+            os.rename(copy.name, tarfnm)
+        else:
+            delete(tarfnm)
+    except:
+        if copy is not None:
+            copy.close()
+            delete(copy.name)
+        if os.path.isdir(staging):
+            shutil.rmtree(staging)
+        raise
+    finally:
+        response.close()
+
+    # move the complete template into place, replacing only its own entries
+    unpacked_dir = os.path.join(basedir, 'unpacked')
+    for name in set(m.name.split('/')[0] for m in members):
+        target = os.path.join(unpacked_dir, name)
+        if os.path.isdir(target) and not os.path.islink(target):
+            shutil.rmtree(target)
+        os.rename(os.path.join(staging, name), target)
+    shutil.rmtree(staging)
+    index = _write_index(tarfnm, members)
+    if blocks is not None and keep_tar:
+        atomic_write(blockhash.manifest_fnm(tarfnm), blockhash.dumps(blocks))
+    _link_unpacked(storage_pool, vm_type, index)
+    atomic_write("%s.pfff" % tarfnm, remote_hash)
+    return vm_type, localfile
+
+
+def _is_contained(path):
+    return not (os.path.isabs(path) or path in ('.', '..') or path.startswith('../'))
+
+
+def _member_name(member, template):
+    """Return normalized name of a tarball member (without a leading ./), or
+    None for the root folder of the archive. Members which would be extracted
+    outside of the target folder are rejected."""
+    name = os.path.normpath(member.name)
+    if name == '.' and member.isdir():
+        return None
+    if not _is_contained(name):
+        raise TemplateException("Template %s has an invalid member '%s'" %
+                                (template, member.name))
+    if member.issym():
+        target = os.path.normpath(os.path.join(os.path.dirname(name), member.linkname))
+    elif member.islnk():
+        target = member.linkname = os.path.normpath(member.linkname)
+    else:
+        target = name
+    if not _is_contained(target):
+        raise TemplateException("Template %s has a link '%s' pointing outside of it" %
+                                (template, member.name))
+    return name
+
+
+_MEMBER_TYPES = {tarfile.REGTYPE: 'file', tarfile.AREGTYPE: 'file',
+                 tarfile.DIRTYPE: 'dir', tarfile.SYMTYPE: 'symlink',
+                 tarfile.LNKTYPE: 'hardlink'}
+
+
+def _write_index(templatefile, members):
+    """Save index of tarball members (TarInfo objects) as <template>.tar.index:
+    name, offset of the data in the tarball, size and type of every member"""
+    index = [dict(name=m.name, offset=m.offset_data, size=m.size,
+                  type=_MEMBER_TYPES.get(m.type, 'other')) for m in members]
+    atomic_write("%s.index" % templatefile, json.dumps(index) + '\n')
+    return index
+
+
+def get_template_index(templatefile):
+    """Return member index of a template tarball as a list of dictionaries
+    with name, offset, size and type (file, dir, symlink, hardlink or other).
+    The tarball is only read if there is no saved index yet."""
+    try:
+        with open("%s.index" % templatefile) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        tmpl = tarfile.open(templatefile)
+        try:
+            return _write_index(templatefile, tmpl.getmembers())
+        finally:
+            tmpl.close()
+
+
+def read_template_member(templatefile, name):
+    """Return contents of a single file of a template tarball, read directly
+    from its offset without scanning the archive"""
+    for member in get_template_index(templatefile):
+        if member['name'] == name and member['type'] == 'file':
+            with open(templatefile, 'rb') as f:
+                f.seek(member['offset'])
+                return f.read(member['size'])
+    raise TemplateException("%s not found in %s" % (name, templatefile))
 
 
 def import_template(template, vm_type, storage_pool = c('general', 'default-storage-pool')):
@@ -121,12 +460,18 @@ def rename_template(storage_pool, vm_type, template,new_template):
     templatefile = "%s/%s/%s/%s.tar" % (storage_endpoint, storage_pool,vm,
                                         template)
     new_templatefile = "%s/%s/%s/%s.tar" % (storage_endpoint, storage_pool,vm,new_template)
-    if os.path.isfile(new_templatefile):
+    # streamed templates might not keep the tarball, only its index
+    if os.path.isfile(new_templatefile) or os.path.isfile(new_templatefile + '.index'):
         return
     else:
-        os.rename(templatefile,new_templatefile)
+        if os.path.isfile(templatefile):
+            os.rename(templatefile, new_templatefile)
         if os.path.isfile(os.path.join(templatefile+'.pfff')):
             os.rename (os.path.join(templatefile+'.pfff'),os.path.join(new_templatefile+'.pfff'))
+        if os.path.isfile(blockhash.manifest_fnm(templatefile)):
+            os.rename(blockhash.manifest_fnm(templatefile), blockhash.manifest_fnm(new_templatefile))
+        if os.path.isfile(templatefile + '.index'):
+            os.rename(templatefile + '.index', new_templatefile + '.index')
         ovfpath = "%s/%s/%s/unpacked/" % (storage_endpoint, storage_pool,vm)
         os.rename (os.path.join(ovfpath,template+".ovf"),os.path.join(ovfpath,new_template+".ovf"))
         if os.path.isfile(os.path.join(ovfpath,template+".tar.gz")):
@@ -141,8 +486,7 @@ def delete_template(storage_pool, vm_type, template):
     storage_endpoint = c('general', 'storage-endpoint')
     templatefile = "%s/%s/%s/%s.tar" % (storage_endpoint, storage_pool, vm_type,
                                         template)
-    tmpl = tarfile.open(templatefile)
-    for packed_file in tmpl.getnames():
+    for packed_file in [m['name'] for m in get_template_index(templatefile)]:
         fnm = "%s/%s/%s/unpacked/%s" % (storage_endpoint, storage_pool, vm_type,
                                         packed_file)
         if not os.path.isdir(fnm):
@@ -152,6 +496,8 @@ def delete_template(storage_pool, vm_type, template):
     # remove master copy
     delete(templatefile)
     delete("%s.pfff" % templatefile)
+    delete("%s.index" % templatefile)
+    delete(blockhash.manifest_fnm(templatefile))
     # also remove symlink for openvz vm_type
     if vm_type == 'openvz':
         delete("%s/%s" % (c('general', 'openvz-templates'), "%s.tar.gz" % template))
@@ -165,10 +511,17 @@ def unpack_template(storage_pool, vm_type, tmpl_name):
     tmpl = tarfile.open(os.path.join(basedir, "%s.tar" %tmpl_name))
     unpacked_dir = os.path.join(basedir, 'unpacked')
     tmpl.extractall(unpacked_dir)
+    index = _write_index(tmpl.name, tmpl.getmembers())
+    tmpl.close()
+    _link_unpacked(storage_pool, vm_type, index)
+
+
+def _link_unpacked(storage_pool, vm_type, index):
+    """Adds symlinks needed by the VM type of an unpacked template"""
     # special case for openvz vm_type
     if vm_type == 'openvz':
         from opennode.cli.actions import vm
-        tmpl_name = [fnm for fnm in tmpl.getnames() if fnm.endswith('tar.gz')]
+        tmpl_name = [m['name'] for m in index if m['name'].endswith('tar.gz')]
         # make sure we have only a single tarball with the image
         assert len(tmpl_name) == 1
         vm.openvz.link_template(storage_pool, tmpl_name[0])
@@ -176,9 +529,26 @@ def unpack_template(storage_pool, vm_type, tmpl_name):
 
 def get_local_templates(vm_type, storage_pool=c('general', 'default-storage-pool')):
     """Returns a list of templates of a certain vm_type from the storage pool"""
-    storage_endpoint = c('general', 'storage-endpoint')
-    return [tmpl[:-4] for tmpl in os.listdir("%s/%s/%s" % (storage_endpoint,
-                                storage_pool, vm_type)) if tmpl.endswith('tar')]
+    folder = os.path.join(c('general', 'storage-endpoint'), storage_pool, vm_type)
+
+    def scan():
+        files = os.listdir(folder)
+        templates = [tmpl[:-4] for tmpl in files if tmpl.endswith('tar')]
+        # streamed templates might not keep the tarball
+        templates += [tmpl[:-10] for tmpl in files if tmpl.endswith('.tar.index')
+                      and tmpl[:-6] not in files]
+        return templates
+    cat = _get_catalog(storage_pool)
+    if cat is not None:
+        try:
+            return cat.list_names(folder, scan)
+        except catalog.sqlite3.Error:
+            pass
+    return scan()
+
+
+def _get_catalog(storage_pool):
+    return catalog.get_catalog(os.path.join(c('general', 'storage-endpoint'), storage_pool))
 
 
 def sync_oms_template(storage_pool=c('general', 'default-storage-pool')):
@@ -190,18 +560,114 @@ def sync_oms_template(storage_pool=c('general', 'default-storage-pool')):
 
 def is_fresh(localfile, remotefile):
     """Checks whether local copy matches remote file"""
-    # get remote hash
-    remote_hashfile = urlopen("%s.tar.pfff" % remotefile)
-    remote_hash = remote_hashfile.read()
-    remote_hashfile.close()
-    # get a local one
+    return _get_remote_hash(remotefile) == _get_local_hash(localfile)
+
+
+def _get_remote_hash(remotefile, ttl=None):
+    url, template = os.path.split(remotefile)
+    manifest = get_manifest(url, ttl)
+    if manifest is not None:
+        if template not in manifest['templates']:
+            raise TemplateException("Template %s not found in %s" % (template, url))
+        return str(manifest['templates'][template]['hash'])
+    return httpcache.fetch("%s.tar.pfff" % remotefile, ttl)
+
+
+def get_mirrors(remote_repo):
+    """Return reachable mirrors of a repository (its 'mirrors' setting, e.g.
+    peers serving their storage pools), fastest first. Latency of a mirror is
+    measured at most once per metadata-cache-ttl."""
+    mirrors = [m.strip() for m in config.cget(remote_repo, 'mirrors', '').split(',')
+               if m.strip()]
+    ttl = int(config.cget('general', 'metadata-cache-ttl', httpcache.DEFAULT_TTL))
+    now = time.time()
+    latencies = []
+    for mirror in mirrors:
+        with _latency_lock:
+            measured = _latencies.get(mirror)
+        if measured is None or now - measured[0] > ttl:
+            measured = (now, _measure_latency(mirror))
+            with _latency_lock:
+                _latencies[mirror] = measured
+        if measured[1] is not None:
+            latencies.append((measured[1], mirror))
+    return [mirror for latency, mirror in sorted(latencies)]
+
+
+# mirror url -> (time of measurement, latency in seconds or None if unreachable)
+_latencies = {}
+_latency_lock = threading.Lock()
+
+
+def _measure_latency(url, timeout=5):
+    """Return seconds it takes to fetch the template list of a repository,
+    None if it cannot be fetched"""
+    start = time.time()
+    try:
+        response = open_url("%s/templatelist.txt" % url.rstrip('/'), timeout=timeout)
+        try:
+            response.read()
+        finally:
+            response.close()
+    except (IOError, socket.error, httplib.HTTPException):
+        return None
+    return time.time() - start
+
+
+def _get_sources(remote_repo, template, remote_hash):
+    """Return base URLs to download a template from: mirrors having the same
+    version of it, fastest first, followed by the repository itself"""
+    sources = []
+    for mirror in get_mirrors(remote_repo):
+        try:
+            mirror_hash = _get_remote_hash(os.path.join(mirror, template), 0)
+        except (IOError, socket.error, httplib.HTTPException, TemplateException):
+            continue
+        if mirror_hash.split()[:1] == remote_hash.split()[:1]:
+            sources.append(mirror)
+    return sources + [c(remote_repo, 'url')]
+
+
+def _open_source(sources, template):
+    """Open the template tarball at the first of the sources that responds"""
+    for i, source in enumerate(sources):
+        try:
+            return open_url("%s.tar" % os.path.join(source, template))
+        except (IOError, socket.error, httplib.HTTPException):
+            if i == len(sources) - 1:
+                raise
+
+
+def _get_remote_sha256(remotefile):
+    """Return SHA-256 of a remote template published in the repository
+    manifest, or None"""
+    url, template = os.path.split(remotefile)
+    manifest = get_manifest(url)
+    if manifest is None or template not in manifest['templates']:
+        return None
+    sha256 = manifest['templates'][template].get('sha256')
+    return str(sha256) if sha256 else None
+
+
+def _get_remote_blocks(remotefile):
+    """Return block hash manifest published next to a remote template, or None"""
+    blocks = httpcache.fetch(blockhash.manifest_fnm("%s.tar" % remotefile), 0,
+                             missing_ok=True)
+    if blocks is None:
+        return None
+    try:
+        return blockhash.loads(blocks)
+    except ValueError:
+        return None
+
+
+def _get_local_hash(localfile):
     try:
         with open("%s.tar.pfff" % localfile, 'r') as f:
-            local_hash = f.read()
+            return f.read()
     except IOError:
         # no local hash found
-        return False 
-    return remote_hash == local_hash
+        return None
 
 
 def list_templates():
@@ -222,8 +688,12 @@ def list_templates():
         url, vm_type = config.c(repo_group, "url"), config.c(repo_group, "type")
         print "%s remote templates:" % vm_type.upper()
         print "\t", "Repository:", url
+        manifest = get_manifest(url)
         for tmpl in get_template_list(repo_group):
-            print "\t\t",  tmpl
+            if manifest is not None:
+                print "\t\t", tmpl, "(%.1f MB)" % (manifest['templates'][tmpl]['size'] / 1024.0 ** 2)
+            else:
+                print "\t\t",  tmpl
         print
 
 
@@ -234,48 +704,68 @@ def get_purely_local_templates(storage_pool, vm_type, remote_repo):
 
 
 def get_template_info(template_name, vm_type, storage_pool = c('general', 'default-storage-pool')):
-    ovf_file = OvfFile(os.path.join(c("general", "storage-endpoint"),
-                                        storage_pool, vm_type, "unpacked",
-                                        template_name + ".ovf"))
+    return get_templates_info([template_name], vm_type, storage_pool)[0]
+
+
+def get_templates_info(template_names, vm_type, storage_pool=c('general', 'default-storage-pool')):
+    """Return a list of settings of the templates. Parsed settings are kept
+    in the template catalog of the storage pool and only re-read when the
+    OVF file or the defaults configuration change."""
+    ovf_paths = [os.path.join(c("general", "storage-endpoint"), storage_pool, vm_type,
+                              "unpacked", template_name + ".ovf")
+                 for template_name in template_names]
     vm = vm_ops.get_module(vm_type)
-    template_settings = vm.get_ovf_template_settings(ovf_file)
+
+    for template_name, ovf_path in zip(template_names, ovf_paths):
+        if not os.path.exists(ovf_path):
+            # restore a missing OVF straight from the tarball
+            templatefile = os.path.join(c("general", "storage-endpoint"), storage_pool,
+                                        vm_type, template_name + ".tar")
+            if os.path.exists(templatefile):
+                atomic_write(ovf_path, read_template_member(templatefile,
+                                                            template_name + ".ovf"))
+
+    def parse(ovf_path):
+        if vm_type == 'openvz':
+            # CTID is assigned below, it doesn't belong to the template
+            return vm.get_ovf_template_settings(OvfFile(ovf_path), with_ct_id=False)
+        return vm.get_ovf_template_settings(OvfFile(ovf_path))
+    cat = _get_catalog(storage_pool)
+    template_settings = None
+    if cat is not None:
+        try:
+            template_settings = cat.get_settings(ovf_paths, parse, config.signature(vm_type))
+        except catalog.sqlite3.Error:
+            pass
+    if template_settings is None:
+        template_settings = map(parse, ovf_paths)
+    if vm_type == 'openvz' and template_settings:
+        vm_id = vm._get_available_ct_id()
+        for settings in template_settings:
+            settings["vm_id"] = vm_id
     # XXX handle modification to system params
     #errors = vm.adjust_setting_to_systems_resources(template_settings)
     return template_settings
 
 
-def get_templates_sync_list(sync_tasks_fnm=c('general', 'sync_task_list')):
-    """Return current template synchronisation list"""
-    with open(sync_tasks_fnm, 'r') as tf:
-        return pickle.load(tf)
-
-
-def set_templates_sync_list(tasks, sync_tasks_fnm=c('general', 'sync_task_list')):
-    """Set new template synchronisation list. Function should be handled with care,
-    as some retrieval might be in progress"""
-    with open(sync_tasks_fnm, 'w') as tf:
-        pickle.dump(tasks, tf)
+def get_sync_status(sync_tasks_fnm=c('general', 'sync_task_list')):
+    """Return a list of template synchronisation jobs as dictionaries with
+    id, template, storage_pool, remote_repo, state (queued, running, done or
+    failed), done and total bytes, rate in bytes per second, error and time
+    of the last change"""
+    return syncqueue.get_queue(sync_tasks_fnm).status()[0]
 
 
-def sync_templates_list(sync_tasks_fnm=c('general', 'sync_task_list')):
-    """Sync a list of templates defined in a file. After synchronizing a template,
-    removes it from the list. NB: multiple copies of this function should be run
-    against the same task list file!"""
-    if os.path.exists(sync_tasks_fnm):
-        tasks = get_templates_sync_list(sync_tasks_fnm)
-        while tasks:
-            
-            # this doesn't make sense the first time, but for resilience we reread a list
-            # each time a template was downloaded
-            tasks = get_templates_sync_list(sync_tasks_fnm)
-            template, storage_pool, remote_repo = tasks[0]
-            # XXX a separate download hook for dumping progress to a file?
-            sync_template(remote_repo, template, storage_pool)
-            del tasks[0]
-            set_templates_sync_list(tasks, sync_tasks_fnm)
-        os.unlink(sync_tasks_fnm)
+def get_templates_sync_progress(sync_tasks_fnm=c('general', 'sync_task_list')):
+    """Return progress of the latest synchronisation of every template as a
+    dictionary of template: {'state', 'done', 'total', 'rate', 'error'}"""
+    res = {}
+    for job in get_sync_status(sync_tasks_fnm):
+        res[job['template']] = dict((k, job.get(k)) for k in ('state', 'done', 'total',
+                                                              'rate', 'error'))
+    return res
 
 
-def is_syncing():
+def is_syncing(sync_tasks_fnm=c('general', 'sync_task_list')):
     """Return true if syncing in progress"""
-    return int(execute("screen -ls |grep OPENNODE-SYNC| wc -l")) == 1
+    return syncqueue.get_queue(sync_tasks_fnm).is_active()
@@ -0,0 +1,111 @@
+"""
+Fixed-size in-memory store of metric samples.
+
+Samples are not persisted, so after a restart of the process rates are
+reported as zero until a second sample has been taken.
+"""
+
+import threading
+import time
+from array import array
+
+
+class RingBuffer(object):
+    """Last `size` samples of a metric. Each sample is a timestamp and a fixed
+    number of values, all kept in a single preallocated array of doubles."""
+
+    def __init__(self, size, width):
+        self.size = size
+        self.width = width
+        self.count = 0
+        self.head = 0  # next slot to write
+        self.data = array('d', [0.0] * (size * (width + 1)))
+
+    def append(self, timestamp, values):
+        if len(values) != self.width:
+            raise ValueError("Expected %s values, got %s" % (self.width, len(values)))
+        offset = self.head * (self.width + 1)
+        self.data[offset] = timestamp
+        self.data[offset + 1:offset + 1 + self.width] = array('d', values)
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def sample(self, age):
+        """Return (timestamp, values) of a sample, 0 being the latest one"""
+        if age >= self.count:
+            raise IndexError("Only %s samples stored" % self.count)
+        offset = ((self.head - 1 - age) % self.size) * (self.width + 1)
+        return self.data[offset], self.data[offset + 1:offset + 1 + self.width].tolist()
+
+    def samples(self, count=None):
+        """Return up to `count` latest samples, oldest first"""
+        count = self.count if count is None else min(count, self.count)
+        return [self.sample(age) for age in range(count - 1, -1, -1)]
+
+
+class SampleStore(object):
+    """Ring buffers of samples keyed by (key, metric), e.g. (vm uuid, 'cpu')"""
+
+    def __init__(self, size=60):
+        self.size = size
+        self.buffers = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, metric, values, timestamp=None):
+        """Record a sample of counter values"""
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            buf = self.buffers.get((key, metric))
+            if buf is None or buf.width != len(values):
+                buf = self.buffers[(key, metric)] = RingBuffer(self.size, len(values))
+            buf.append(timestamp, values)
+
+    def delta(self, key, metric, window=None):
+        """
+        Return (seconds, [value deltas]) between the latest sample and the oldest
+        one not older than `window` seconds (or the oldest stored sample).
+        Return None if there are less than two samples.
+        """
+        with self._lock:
+            buf = self.buffers.get((key, metric))
+            if buf is None or buf.count < 2:
+                return None
+            t2, last = buf.sample(0)
+            age = buf.count - 1
+            if window is not None:
+                while age > 1 and t2 - buf.sample(age)[0] > window:
+                    age -= 1
+            t1, first = buf.sample(age)
+        return t2 - t1, [v2 - v1 for v2, v1 in zip(last, first)]
+
+    def rates(self, key, metric, window=None):
+        """Return per second rates of counter values over the window, or None"""
+        delta = self.delta(key, metric, window)
+        if delta is None or delta[0] <= 0:
+            return None
+        seconds, deltas = delta
+        return [d / seconds for d in deltas]
+
+    def history(self, key, metric, count=None):
+        """Return latest samples as a list of (timestamp, values), oldest first"""
+        with self._lock:
+            buf = self.buffers.get((key, metric))
+            if buf is None:
+                return []
+            return buf.samples(count)
+
+    def keys(self):
+        """Return keys having samples stored"""
+        with self._lock:
+            return set(k[0] for k in self.buffers)
+
+    def forget(self, key):
+        """Drop all samples of a key"""
+        with self._lock:
+            for k in [k for k in self.buffers if k[0] == key]:
+                del self.buffers[k]
+
+
+# per process store of metric samples
+store = SampleStore()
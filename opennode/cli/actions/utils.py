@@ -6,14 +6,25 @@ import shlex
 import ConfigParser
 import shutil
 import urllib
+import urllib2
 import urlparse
-import cPickle as pickle
+import httplib
+import socket
+import tempfile
+import threading
+import time
+import signal
 
 
 from progressbar import Bar, ETA, FileTransferSpeed, Percentage, ProgressBar, \
                         RotatingMarker
 
 
+# files modified within this many seconds are not cached by mtime, as a change
+# within the same mtime tick would go unnoticed
+MTIME_GRACE = 2
+
+
 class CommandException(Exception):
 
     def __init__(self, msg, code=None):
@@ -44,6 +55,31 @@ def delete(fnm):
         pass
 
 
+def atomic_write(fnm, data):
+    """Replace contents of a file with data. Readers see either the old or the
+    new contents, never a partially written file."""
+    fd, tmp = tempfile.mkstemp(prefix='.%s.' % os.path.basename(fnm),
+                               dir=os.path.dirname(os.path.abspath(fnm)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, fnm)
+    except:
+        delete(tmp)
+        raise
+
+
+def is_process_alive(pid):
+    """Return True if a process with the pid exists"""
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
 def del_folder(path):
     shutil.rmtree(path)
 
@@ -52,12 +88,72 @@ def get_file_size_bytes(path):
     return int(os.stat(path)[6])
 
 
+class _ChildProcesses(object):
+    """Commands run by a call of a run_concurrently worker, killed when the
+    call times out. Commands started after that fail at once."""
+
+    def __init__(self):
+        self.procs = set()
+        self.cancelled = False
+        self._lock = threading.Lock()
+
+    def start(self, cmd):
+        with self._lock:
+            if self.cancelled:
+                raise CommandException("Command '%s' cancelled, the call timed out" % cmd)
+            p = subprocess.Popen("{ LC_ALL=C %s; } 2>&1" % cmd, shell=True,
+                                 stdout=subprocess.PIPE, close_fds=True,
+                                 preexec_fn=os.setpgrp)
+            self.procs.add(p)
+            return p
+
+    def finish(self, p):
+        with self._lock:
+            self.procs.discard(p)
+
+    def cancel(self):
+        """Kill process groups of running commands, return True if there were any"""
+        with self._lock:
+            self.cancelled = True
+            killed = False
+            for p in self.procs:
+                try:
+                    os.killpg(p.pid, signal.SIGKILL)
+                    killed = True
+                except OSError:
+                    pass
+            return killed
+
+
+# commands run by a run_concurrently worker thread are tracked here
+_tracked = threading.local()
+
+
+def _execute_tracked(cmd, children):
+    """commands.getstatusoutput in a separate process group, which is
+    registered in children"""
+    p = children.start(cmd)
+    try:
+        output = p.communicate()[0]
+    finally:
+        children.finish(p)
+    if output[-1:] == '\n':
+        output = output[:-1]
+    # same status encoding as commands.getstatusoutput
+    status = p.returncode << 8 if p.returncode >= 0 else -p.returncode
+    return status, output
+
+
 def execute(cmd):
     """
     Run cmd in a shell, return output of the execution. Raise exception for
     non-0 return code
     """
-    status, output = commands.getstatusoutput("LC_ALL=C %s" % cmd)
+    children = getattr(_tracked, 'children', None)
+    if children is None:
+        status, output = commands.getstatusoutput("LC_ALL=C %s" % cmd)
+    else:
+        status, output = _execute_tracked(cmd, children)
     if status != 0:
         raise CommandException("Failed to execute command '%s'. Status: '%s'. Output: '%s'"
                                % (cmd, status, output), status)
@@ -76,8 +172,21 @@ def execute2(cmd):
 
 
 def calculate_hash(target_file):
-    """Hash contents of a file and write hashes out to a file"""
-    execute("pfff -k 6996807 -B %s > %s.pfff" % (target_file, target_file))
+    """Hash contents of a file and write hashes out to a file: a pfff hash to
+    <target_file>.pfff and a block hash manifest to <target_file>.blocks.
+    Hashes not older than the file are kept."""
+    from opennode.cli.actions import blockhash
+    pfff_fnm = "%s.pfff" % target_file
+    if not (os.path.exists(pfff_fnm) and
+            os.stat(pfff_fnm).st_mtime >= os.stat(target_file).st_mtime):
+        execute("pfff -k 6996807 -B %s > %s" % (target_file, pfff_fnm))
+    if not blockhash.is_current(target_file):
+        blockhash.write(target_file)
+
+
+def get_hash(target_file):
+    """Return pfff hash of a file, in the format written by calculate_hash"""
+    return execute("pfff -k 6996807 -B %s" % target_file)
 
 
 def execute_in_screen(name, cmd):
@@ -160,13 +269,151 @@ class BasicURLOpener(urllib.FancyURLopener):
         return (self.username, self.password)
 
 
-def download(remote, local):
+def download(remote, local, hook=None, verify=None, retries=5, timeout=60, limiter=None):
     """Download a remote file to a local file, using optional username/password
-    for basic HTTP authentication"""
+    for basic HTTP authentication. Progress is reported to a urllib compatible
+    hook, a console progress bar by default. Throughput is limited by an
+    optional TokenBucket.
+
+    Data is written to <local>.part. A dropped connection is retried up to
+    `retries` times, continuing from the end of the .part file with an HTTP
+    Range request, also across separate download calls. The finished file is
+    checked with verify(partfile), if given, and renamed to local."""
     url = urlparse.urlsplit(remote)
-    opener = BasicURLOpener(url.username, url.password)
-    download_monitor = ConsoleProgressBar(url.path.split('/')[-1])
-    opener.retrieve(remote, local, download_monitor.download_hook)
+    if hook is None:
+        hook = ConsoleProgressBar(url.path.split('/')[-1]).download_hook
+    partfile = "%s.part" % local
+    resumed = os.path.exists(partfile)
+    attempt = 0
+    while True:
+        try:
+            _download_range(remote, partfile, hook, timeout, limiter)
+            break
+        except urllib2.HTTPError, e:
+            # retrying won't help with missing files or access errors
+            if e.code < 500 or attempt >= retries:
+                raise
+        except (IOError, socket.error, httplib.HTTPException):
+            if attempt >= retries:
+                raise
+        attempt += 1
+        time.sleep(min(2 ** attempt, 30))
+    if verify is not None and not verify(partfile):
+        delete(partfile)
+        if resumed:
+            # left over from a download of an older version, start from scratch
+            return download(remote, local, hook, verify, retries, timeout, limiter)
+        raise IOError("Downloaded file %s doesn't match its hash" % remote)
+    os.rename(partfile, local)
+
+
+def open_url(remote, headers=None, timeout=60):
+    """Open a URL with urllib2, taking basic authentication credentials from
+    the username:password@ part of the URL. Unlike urlopen, HTTP errors are
+    raised as urllib2.HTTPError."""
+    url = urlparse.urlsplit(remote)
+    handlers = []
+    if url.username is not None:
+        netloc = url.hostname + (':%s' % url.port if url.port else '')
+        remote = urlparse.urlunsplit((url.scheme, netloc, url.path, url.query, url.fragment))
+        passwords = urllib2.HTTPPasswordMgrWithDefaultRealm()
+        passwords.add_password(None, remote, url.username, url.password)
+        handlers.append(urllib2.HTTPBasicAuthHandler(passwords))
+    request = urllib2.Request(remote, headers=headers or {})
+    return urllib2.build_opener(*handlers).open(request, timeout=timeout)
+
+
+def _download_range(remote, partfile, hook, timeout, limiter=None, block_size=64 * 1024):
+    """Download remote to partfile, continuing from its current end"""
+    offset = os.path.getsize(partfile) if os.path.exists(partfile) else 0
+    headers = {'Range': 'bytes=%s-' % offset} if offset else {}
+    try:
+        response = open_url(remote, headers, timeout)
+    except urllib2.HTTPError, e:
+        if e.code != 416:
+            raise
+        # range not satisfiable, the file is either complete or has changed
+        content_range = e.info().get('Content-Range', '')
+        if content_range.endswith('/%s' % offset):
+            return
+        delete(partfile)
+        raise IOError("Partial download of %s is invalid, starting over" % remote)
+    try:
+        info = response.info()
+        content_range = info.get('Content-Range')
+        if response.getcode() == 206 and content_range:
+            # Content-Range: bytes first-last/total
+            first, total = content_range.split(' ')[-1].split('/')
+            if int(first.split('-')[0]) != offset:
+                raise IOError("Server returned unexpected range %s" % content_range)
+            mode = 'ab'
+        else:
+            # full content, the server doesn't support ranges
+            offset, total, mode = 0, info.get('Content-Length'), 'wb'
+        total = int(total) if total and total != '*' else -1
+        done = offset
+        with open(partfile, mode) as f:
+            while True:
+                block = response.read(block_size)
+                if not block:
+                    break
+                f.write(block)
+                done += len(block)
+                if limiter is not None:
+                    limiter.consume(len(block))
+                # report bytes done as a single block of the urllib hook
+                hook(1, done, total)
+        if total >= 0 and done < total:
+            raise IOError("Connection closed after %s of %s bytes" % (done, total))
+        hook(1, done, done if total < 0 else total)
+    finally:
+        response.close()
+
+
+class TokenBucket(object):
+    """Limits throughput to `rate` bytes per second, allowing bursts of up to
+    a second worth of data. rate can be a callable, which is called again
+    every `refresh` seconds, so that the limit can be changed during a
+    transfer. A rate of 0 or None means no limit. Bytes that went through
+    the bucket are counted in `consumed`."""
+
+    def __init__(self, rate, refresh=1.0):
+        self._rate = rate if callable(rate) else (lambda: rate)
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self.rate = self._rate()
+        self.tokens = self.rate or 0
+        self.last = self.checked = time.time()
+        self.consumed = 0
+
+    def consume(self, amount):
+        """Take amount bytes worth of tokens, sleeping until they are available"""
+        with self._lock:
+            self.consumed += amount
+            now = time.time()
+            if now - self.checked >= self.refresh:
+                self.rate = self._rate()
+                self.checked = now
+            if not self.rate:
+                self.last = now
+                return
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            wait = -self.tokens / float(self.rate)
+        if wait > 0:
+            time.sleep(wait)
+
+
+def parse_size(value):
+    """Parse a size like 512K, 10M or 1G (powers of 1024) into bytes"""
+    value = str(value).strip().upper()
+    if not value:
+        return 0
+    multipliers = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if value[-1] in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1]])
+    return int(value)
 
 
 def urlopen(remote):
@@ -177,21 +424,83 @@ def urlopen(remote):
     return opener.open(remote)
 
 
-def roll_data(filename, data, default=None):
-    """Save data in a file. Return previous value of the data."""
-    try:
-        if os.path.exists(filename):
-            with open(filename, 'r') as od:
-                res = pickle.load(od)
-            with open(filename, 'w') as od:
-                pickle.dump(data, od)
-            return res
-        else:
-            with open(filename, 'w') as od:
-                pickle.dump(data, od)
-            return default
-    except EOFError:
-        return default
+def run_concurrently(fun, items, workers=8, timeout=None):
+    """
+    Call fun(item) for every item in a bounded pool of worker threads.
+    Duplicate items are called only once.
+
+    Each call gets `timeout` seconds from the moment it starts. Commands the
+    call runs with execute() are killed when it doesn't finish in time, so its
+    worker gets back to the remaining items. A call that had no commands to
+    kill is abandoned instead (its thread is left to finish on its own) and a
+    replacement worker takes over the remaining items.
+
+    @return: (results, failures, timed_out) - results and failures (exception
+             messages) are dictionaries keyed by item, timed_out is a list
+    """
+    seen = set()
+    items = [item for item in items if not (item in seen or seen.add(item))]
+    pending = list(reversed(items))
+    results, failures, timed_out = {}, {}, []
+    started = {}
+    # commands run by the calls in progress, by item
+    children = {}
+    abandoned = set()
+    cond = threading.Condition()
+
+    def worker():
+        while True:
+            with cond:
+                if not pending:
+                    return
+                item = pending.pop()
+                started[item] = time.time()
+                children[item] = _tracked.children = _ChildProcesses()
+                # the timeout of the call starts now
+                cond.notify()
+            try:
+                res, err = fun(item), None
+            except Exception as e:
+                res, err = None, e
+            _tracked.children = None
+            with cond:
+                del children[item]
+                if item in abandoned:
+                    # a replacement worker was started meanwhile
+                    return
+                if item not in timed_out:
+                    del started[item]
+                    if err is not None:
+                        failures[item] = str(err) or err.__class__.__name__
+                    else:
+                        results[item] = res
+                cond.notify()
+
+    def spawn():
+        t = threading.Thread(target=worker)
+        t.setDaemon(True)
+        t.start()
+
+    with cond:
+        for i in range(min(workers, len(items))):
+            spawn()
+        while len(results) + len(failures) + len(timed_out) < len(items):
+            wait = None
+            if timeout is not None:
+                now = time.time()
+                for item, start in started.items():
+                    if now - start >= timeout:
+                        del started[item]
+                        timed_out.append(item)
+                        if item not in children or not children[item].cancel():
+                            abandoned.add(item)
+                            if pending:
+                                spawn()
+                if started:
+                    wait = max(0, min(started.values()) + timeout - now)
+            if len(results) + len(failures) + len(timed_out) < len(items):
+                cond.wait(wait)
+    return results, failures, timed_out
 
 
 def test_passwordless_ssh(remote_host, port=22):
@@ -1,5 +1,7 @@
 import sys
 import os
+import copy
+from contextlib import contextmanager
 from functools import wraps
 import time
 import urlparse
@@ -10,13 +12,17 @@ import libvirt
 
 from ovf.OvfFile import OvfFile
 
-from opennode.cli.actions.vm import kvm, openvz
-from opennode.cli.actions.utils import roll_data, execute
+from opennode.cli.actions.vm import kvm, openvz, inventory, vzmetrics
+from opennode.cli.actions.vm.connection import pool
+from opennode.cli.actions.utils import execute, run_concurrently
+from opennode.cli.actions import sysresources as sysres
+from opennode.cli.actions.timeseries import store
 from opennode.cli import config
 
 __all__ = ['autodetected_backends', 'list_vms', 'info_vm', 'start_vm', 'shutdown_vm',
-           'destroy_vm', 'reboot_vm', 'suspend_vm', 'resume_vm', 'deploy_vm',
-           'undeploy_vm', 'get_local_templates', 'metrics']
+           'destroy_vm', 'reboot_vm', 'suspend_vm', 'resume_vm', 'deploy_vm', 'deploy_vms',
+           'undeploy_vm', 'get_local_templates', 'metrics', 'metrics_history',
+           'connection_stats']
 
 
 vm_types = {
@@ -25,19 +31,28 @@ vm_types = {
     'qemu': kvm,  # synonym for kvm in our case
 }
 
-_connections = {}
+
+@contextmanager
+def _backend_connection(backend):
+    conn = _connection(backend)
+
+    try:
+        yield conn
+    except libvirt.libvirtError:
+        # libvirtd went away during the call, reconnect on the next one
+        if not pool.is_alive(conn):
+            pool.discard(backend, conn)
+        raise
+    finally:
+        if backend.startswith('test://') and backend != 'test:///default':
+            _dump_state(conn, '/tmp/func_vm_test_state.xml')
 
 
 def vm_method(fun):
     @wraps(fun)
     def wrapper(backend, *args, **kwargs):
-        conn = _connection(backend)
-
-        try:
+        with _backend_connection(backend) as conn:
             return fun(conn, *args, **kwargs)
-        finally:
-            if backend.startswith('test://') and backend != 'test:///default':
-                _dump_state(conn, '/tmp/func_vm_test_state.xml')
 
     return wrapper
 
@@ -69,8 +84,10 @@ def _connection(backend):
     if bs and (backend not in bs and not backend.startswith('test://')):
         raise Exception("unsupported backend %s" % backend)
 
-    conn = libvirt.open(backend)
+    return pool.get(backend, on_open=lambda conn: _setup_test_state(backend, conn))
+
 
+def _setup_test_state(backend, conn):
     # implement the 'status="inactive"' extension in the test:/// xml dump
     # so that we can test more complex scenarios.
     if backend.startswith('test://') and backend != "test:///default":
@@ -82,7 +99,10 @@ def _connection(backend):
                 dom = conn.lookupByName(node.findtext('.//name'))
                 dom.shutdown()
 
-    return conn
+
+def connection_stats():
+    """Return counters of the libvirt connection pool: opens, reuses and reconnects"""
+    return pool.stats()
 
 
 def _dump_state(conn, filename):
@@ -99,8 +119,59 @@ def _dump_state(conn, filename):
         print >>f, '</node>'
 
 
-def dom_dom(conn, uuid):
-    return ElementTree.fromstring(conn.lookupByUUIDString(uuid).XMLDesc(0))
+class DomainSnapshot(object):
+    """Domain state fetched from libvirt at most once: info, XML description
+    and its parsed tree. Connection type and URI can be passed in when many
+    domains of the same connection are rendered."""
+
+    def __init__(self, conn, dom, conn_type=None, conn_uri=None):
+        self.conn = conn
+        self.dom = dom
+        self.conn_type = conn_type if conn_type is not None else conn.getType()
+        self.conn_uri = conn_uri if conn_uri is not None else conn.getURI()
+        self._info = None
+        self._xml = None
+        self._tree = None
+        self._uuid = None
+        self._name = None
+
+    @classmethod
+    def by_uuid(cls, conn, uuid):
+        return cls(conn, conn.lookupByUUIDString(uuid))
+
+    @property
+    def info(self):
+        if self._info is None:
+            self._info = self.dom.info()
+        return self._info
+
+    @property
+    def xml(self):
+        if self._xml is None:
+            self._xml = self.dom.XMLDesc(0)
+        return self._xml
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = ElementTree.fromstring(self.xml)
+        return self._tree
+
+    @property
+    def uuid(self):
+        if self._uuid is None:
+            self._uuid = str(UUID(bytes=self.dom.UUID()))
+        return self._uuid
+
+    @property
+    def name(self):
+        if self._name is None:
+            self._name = self.dom.name()
+        return self._name
+
+    @property
+    def is_openvz(self):
+        return self.conn_type == 'OpenVZ'
 
 
 def list_vm_ids(backend):
@@ -108,91 +179,194 @@ def list_vm_ids(backend):
     return map(str, conn.listDefinedDomains() + conn.listDomainsID())
 
 
-def _render_vm(conn, vm):
-    def get_uuid(vm):
-        return str(UUID(bytes=vm.UUID()))
+STATE_MAP = {
+   0: "active",
+   1: "active",
+   2: "active",
+   3: "suspended",
+   4: "inactive",
+   5: "inactive",
+   6: "inactive"
+}
+
+RUN_STATE_MAP = {
+   0: "no_state",
+   1: "running",
+   2: "blocked",
+   3: "suspended",
+   4: "shutting_down",
+   5: "shutoff",
+   6: "crashed"
+}
+
+
+def _vm_name(snap, ct):
+    if snap.is_openvz:
+        return ct.get('hostname')
+    return snap.name
+
+
+def _vm_template_name(snap, ct):
+    if snap.is_openvz:
+        return ct.get('template')
+    return None
+
+
+def _vm_memory(snap, ct):
+    # libvirt doesn't work with openvz
+    if snap.is_openvz:
+        return ct.get('memory', 0)
+    # max memory is reported by libvirt in KB
+    return snap.info[1] / 1024
+
+
+def _vm_uptime(snap, ct):
+    if STATE_MAP[snap.info[0]] != 'active':
+        return None
+
+    # libvirt doesn't work with openvz
+    if snap.is_openvz:
+        if ct.get('uptime') is not None:
+            return ct['uptime']
+        return openvz.get_uptime(snap.name)
+    # XXX: todo use libvirt
+    return 0
+
+
+def _vm_diskspace(snap, ct):
+    if snap.is_openvz:
+        return {'/': ct.get('diskspace', 0.0)}
+    return {'/': 0.0}
+
+
+def _vm_swap(snap, ct):
+    if snap.is_openvz:
+        return ct.get('swap', 0)
+    # XXX use libvirt
+    return 0
+
+
+# extractors of the rendered VM fields, each takes a DomainSnapshot and
+# the OpenVZ container inventory entry
+VM_FIELDS = {
+    'uuid': lambda snap, ct: snap.uuid,
+    'name': _vm_name,
+    'memory': _vm_memory,
+    'uptime': _vm_uptime,
+    'diskspace': _vm_diskspace,
+    'template': _vm_template_name,
+    'state': lambda snap, ct: STATE_MAP[snap.info[0]],
+    'run_state': lambda snap, ct: RUN_STATE_MAP[snap.info[0]],
+    'vm_uri': lambda snap, ct: snap.conn_uri,
+    'vm_type': lambda snap, ct: snap.conn_type.lower(),
+    'swap': _vm_swap,
+    'vcpu': lambda snap, ct: snap.info[3],
+    'consoles': lambda snap, ct: [i for i in [_console_vnc(snap), _console_pty(snap)] if i],
+    'interfaces': lambda snap, ct: _interfaces(snap),
+}
+
+# fields read from openvz.get_inventory for OpenVZ containers
+CT_INVENTORY_FIELDS = set(['name', 'memory', 'uptime', 'diskspace', 'template', 'swap'])
+
+
+def _requested_fields(fields):
+    if fields is None:
+        return VM_FIELDS.keys()
+    fields = list(fields)
+    unknown = set(fields) - set(VM_FIELDS)
+    if unknown:
+        raise ValueError("Unknown VM field(s): %s" % ', '.join(sorted(unknown)))
+    return fields
+
+
+def _render_vm(conn, vm, conn_type=None, conn_uri=None, ct_inventory=None, fields=None):
+    """Render a domain, computing only the requested fields (all by default).
+    For OpenVZ, container parameters are read from ct_inventory (see
+    openvz.get_inventory), which is queried for this single container if not
+    provided."""
+    return _render_snapshot(DomainSnapshot(conn, vm, conn_type, conn_uri), ct_inventory, fields)
+
+
+def _render_snapshot(snap, ct_inventory=None, fields=None):
+    fields = _requested_fields(fields)
+
+    ct = {}
+    if snap.is_openvz and CT_INVENTORY_FIELDS.intersection(fields):
+        if ct_inventory is None or snap.name not in ct_inventory:
+            ct_inventory = openvz.get_inventory([snap.name])
+        ct = ct_inventory.get(snap.name, {})
+
+    return dict((field, VM_FIELDS[field](snap, ct)) for field in fields)
+
+
+def _iter_snapshots(conn):
+    """Yield snapshots of running and then of defined domains"""
+    conn_type, conn_uri = conn.getType(), conn.getURI()
+    for vm in (conn.lookupByID(i) for i in _get_running_vm_ids(conn)):
+        yield DomainSnapshot(conn, vm, conn_type, conn_uri)
+    for vm in (conn.lookupByName(i) for i in conn.listDefinedDomains()):
+        yield DomainSnapshot(conn, vm, conn_type, conn_uri)
+
+
+def _iter_vms(conn, fields=None):
+    fields = _requested_fields(fields)
+    # all containers are queried in one go instead of several vzlist calls per CT
+    ct_inventory = None
+    if conn.getType() == 'OpenVZ' and CT_INVENTORY_FIELDS.intersection(fields):
+        ct_inventory = openvz.get_inventory()
+
+    for snap in _iter_snapshots(conn):
+        yield _render_snapshot(snap, ct_inventory, fields)
+
+
+def _list_vms(conn, fields=None):
+    return list(_iter_vms(conn, fields))
+
+
+def _inventory_entry(snap, ct_inventory=None):
+    vm = _render_snapshot(snap, ct_inventory)
+    used_memory = snap.info[2] if vm['state'] == 'active' and snap.dom.ID() > 0 else 0
+    return vm, used_memory
+
+
+def _load_inventory(conn):
+    ct_inventory = openvz.get_inventory() if conn.getType() == 'OpenVZ' else None
+    entries = {}
+    for snap in _iter_snapshots(conn):
+        entries[snap.uuid] = _inventory_entry(snap, ct_inventory)
+    return entries
+
+
+def _load_inventory_entry(conn, dom):
+    return _inventory_entry(DomainSnapshot(conn, dom))
 
-    STATE_MAP = {
-       0: "active",
-       1: "active",
-       2: "active",
-       3: "suspended",
-       4: "inactive",
-       5: "inactive",
-       6: "inactive"
-    }
-
-    RUN_STATE_MAP = {
-       0: "no_state",
-       1: "running",
-       2: "blocked",
-       3: "suspended",
-       4: "shutting_down",
-       5: "shutoff",
-       6: "crashed"
-    }
-
-    info = vm.info()
-
-    def vm_name(vm):
-        if conn.getType() == 'OpenVZ':
-            return openvz.get_hostname(vm.name())
-        return vm.name()
-
-    def vm_template_name(vm):
-        if conn.getType() == 'OpenVZ':
-            return openvz.get_template_name(vm.name())
+
+def _inventory(conn):
+    """Return the in-memory inventory of the connection's VMs, or None if
+    disabled by the 'inventory-cache-interval' option or if the driver
+    doesn't deliver lifecycle events (OpenVZ), as the cache would go stale"""
+    interval = float(config.cget('general', 'inventory-cache-interval', 0))
+    uri = pool.uri_of(conn)
+    if interval <= 0 or uri is None or uri.startswith('test://'):
+        return None
+    cache = inventory.get_cache(uri, _load_inventory, _load_inventory_entry, interval)
+    if not cache.has_events():
         return None
+    return cache
+
 
-    def vm_memory(vm):
-        # libvirt doesn't work with openvz
-        if conn.getType() == 'OpenVZ':
-            return openvz.get_memory(vm.name())
-        # XXX: todo use libvirt
-        return 0
-
-    def vm_uptime(vm, state):
-        if state != 'active':
-            return None
-
-        # libvirt doesn't work with openvz
-        if conn.getType() == 'OpenVZ':
-            return openvz.get_uptime(vm.name())
-        # XXX: todo use libvirt
-        return 0
-
-    def vm_diskspace(vm):
-        if conn.getType() == 'OpenVZ':
-            return {'/': openvz.get_diskspace(vm.name())}
-        return {'/': 0.0}
-
-    def vm_swap(vm):
-        if conn.getType() == 'OpenVZ':
-            return openvz.get_swap(vm.name())
-        # XXX use libvirt
-        return 0
-
-    return {"uuid": get_uuid(vm), "name": vm_name(vm), "memory": vm_memory(vm),
-            "uptime": vm_uptime(vm, STATE_MAP[info[0]]),
-            "diskspace": vm_diskspace(vm),
-            "template": vm_template_name(vm), "state": STATE_MAP[info[0]],
-            "run_state": RUN_STATE_MAP[info[0]],
-            "vm_uri": conn.getURI(),
-            "vm_type": conn.getType().lower(),
-            "swap": vm_swap(vm),
-            "vcpu": vm.info()[3],
-            'consoles': [i for i in [_vm_console_vnc(conn, get_uuid(vm)),
-                                     _vm_console_pty(conn, get_uuid(vm))] if i],
-            'interfaces': _vm_interfaces(conn, get_uuid(vm))}
-
-
-def _list_vms(conn):
-    online = []
-    online += [_render_vm(conn, vm) for vm in (conn.lookupByID(i) for i \
-                                                    in _get_running_vm_ids(conn))]
-    offline = [_render_vm(conn, vm) for vm in (conn.lookupByName(i) for i \
-                                               in conn.listDefinedDomains())]
-    return online + offline
+def _invalidate_inventory(conn, uuid=None):
+    """Reload a domain (or all) on the next inventory read, without waiting
+    for the lifecycle event"""
+    cache = _inventory(conn)
+    if cache is not None:
+        cache.invalidate(uuid)
+
+
+def _project(vm, fields):
+    if fields is None:
+        return vm
+    return dict((field, vm[field]) for field in _requested_fields(fields))
 
 
 def free_mem():
@@ -204,15 +378,19 @@ def free_mem():
     parameter.
 
     """
-    backends = backends()
+    bs = backends()
 
     # Start with the physical memory and subtract
-    memory = _connection(backends[0]).getInfo()[1]
+    memory = _connection(bs[0]).getInfo()[1]
 
     # Take 256M off which is reserved for Domain-0
     memory = memory - 256
 
-    for conn in (_connection(b) for b in backends):
+    for conn in (_connection(b) for b in bs):
+        cache = _inventory(conn)
+        if cache is not None:
+            memory = memory - cache.used_memory() / 1024
+            continue
         for vm in (conn.lookupByID(i) for i in conn.listDomainsID()):
             # Exclude stopped vms and Domain-0 by using
             # ids greater than 0
@@ -226,20 +404,40 @@ def free_mem():
 
 
 @vm_method
-def list_vms(conn):
-    return _list_vms(conn)
+def list_vms(conn, fields=None):
+    """Return a list of VMs. If fields (an iterable of VM_FIELDS keys) is given,
+    only those fields are computed and returned for each VM."""
+    cache = _inventory(conn)
+    if cache is not None:
+        return [_project(vm, fields) for vm in cache.list()]
+    return _list_vms(conn, fields)
+
+
+def iter_vms(backend, fields=None):
+    """Generator version of list_vms, VMs are rendered one at a time"""
+    # libvirt is called while iterating, so the connection is managed here
+    # and not by vm_method, which returns before the first VM is rendered
+    with _backend_connection(backend) as conn:
+        for vm in _iter_vms(conn, fields):
+            yield vm
 
 
 @vm_method
 def info_vm(conn, uuid):
+    cache = _inventory(conn)
+    if cache is not None:
+        vm = cache.get(uuid)
+        if vm is not None:
+            return vm
     dom = conn.lookupByUUIDString(uuid)
-    return _render_vm(dom)
+    return _render_vm(conn, dom)
 
 
 @vm_method
 def start_vm(conn, uuid):
     dom = conn.lookupByUUIDString(uuid)
     dom.create()
+    _invalidate_inventory(conn, uuid)
 
 
 @vm_method
@@ -250,12 +448,14 @@ def shutdown_vm(conn, uuid):
     else:
         dom = conn.lookupByUUIDString(uuid)
         dom.shutdown()
+    _invalidate_inventory(conn, uuid)
 
 
 @vm_method
 def destroy_vm(conn, uuid):
     dom = conn.lookupByUUIDString(uuid)
     dom.destroy()
+    _invalidate_inventory(conn, uuid)
 
 
 @vm_method
@@ -279,18 +479,21 @@ def reboot_vm(conn, uuid):
                         continue
                     raise e
             dom.create()
+    _invalidate_inventory(conn, uuid)
 
 
 @vm_method
 def suspend_vm(conn, uuid):
     dom = conn.lookupByUUIDString(uuid)
     dom.suspend()
+    _invalidate_inventory(conn, uuid)
 
 
 @vm_method
 def resume_vm(conn, uuid):
     dom = conn.lookupByUUIDString(uuid)
     dom.resume()
+    _invalidate_inventory(conn, uuid)
 
 
 @vm_method
@@ -302,31 +505,53 @@ def deploy_vm(conn, vm_parameters):
         _deploy_vm(vm_parameters)
     except Exception as e:
         raise e
+    _invalidate_inventory(conn)
     return "OK"
 
 
+@vm_method
+def deploy_vms(conn, vm_parameters, overrides, workers=None):
+    """
+    Deploy a VM for every item of overrides from the template of vm_parameters.
+    Overrides are per VM settings, e.g. hostname, ip_address and memory. The
+    template is parsed and checked against system resources once, the whole
+    batch is rejected if VMs share a hostname or an IP address or don't fit
+    the host together. Up to `workers` (deploy-workers setting by default)
+    VMs are provisioned concurrently.
+
+    @return: a result per VM, in the order of overrides: {'hostname', 'vm_id',
+             'status': 'OK', 'timings'} or {'hostname', 'vm_id',
+             'status': 'error', 'error'}
+    """
+    try:
+        return _deploy_vms(vm_parameters, overrides, workers)
+    finally:
+        _invalidate_inventory(conn)
+
+
 @vm_method
 def undeploy_vm(conn, uuid):
     dom = conn.lookupByUUIDString(uuid)
     dom.undefine()
+    _invalidate_inventory(conn, uuid)
 
 
 @vm_method
 def get_local_templates(conn):
     vm_type = conn.getType().lower()
     tmpls = []
-    from opennode.cli.actions.templates import get_template_info, \
+    from opennode.cli.actions.templates import get_templates_info, \
                 get_local_templates as local_templates
-    for tmpl_name in local_templates(vm_type):
-        tmpl_data = get_template_info(tmpl_name, vm_type)
+    tmpl_names = local_templates(vm_type)
+    for tmpl_name, tmpl_data in zip(tmpl_names, get_templates_info(tmpl_names, vm_type)):
         tmpl_data['template_name'] = tmpl_name
         tmpls.append(tmpl_data)
     return tmpls
 
 
-def _vm_console_vnc(conn, uuid):
+def _console_vnc(snap):
     # python 2.6 etree library doesn't support xpath with predicate
-    element = ([i for i in dom_dom(conn, uuid).findall('.//graphics') if \
+    element = ([i for i in snap.tree.findall('.//graphics') if \
                     i.attrib.get('type', None) == 'vnc'] or [None])[0]
     # elementtree element without children is treated as false
     if element != None:
@@ -334,26 +559,33 @@ def _vm_console_vnc(conn, uuid):
         if port and port != '-1':
             return dict(type='vnc', port=port)
 
+
+def _vm_console_vnc(conn, uuid):
+    return _console_vnc(DomainSnapshot.by_uuid(conn, uuid))
+
 vm_console_vnc = vm_method(_vm_console_vnc)
 
 
-def _vm_console_pty(conn, uuid):
+def _console_pty(snap):
     # python 2.6 etree library doesn't support xpath with predicate
-    element = ([i for i in dom_dom(conn, uuid).findall('.//console') if \
+    element = ([i for i in snap.tree.findall('.//console') if \
                     i.attrib.get('type', None) == 'pty'] or [None])[0]
     if element != None:
         pty = element.attrib.get('tty', None)
         if pty:
             return dict(type='pty', pty=pty)
-    elif conn.getType() == 'OpenVZ':
-        return dict(type='openvz', cid=conn.lookupByUUIDString(uuid).name())
+    elif snap.is_openvz:
+        return dict(type='openvz', cid=snap.name)
+
 
+def _vm_console_pty(conn, uuid):
+    return _console_pty(DomainSnapshot.by_uuid(conn, uuid))
 
 vm_console_pty = vm_method(_vm_console_pty)
 
 
-def _vm_interfaces(conn, uuid):
-    elements = dom_dom(conn, uuid).findall('.//interface')
+def _interfaces(snap):
+    elements = snap.tree.findall('.//interface')
 
     def interface(idx, i):
         type = i.attrib.get('type')
@@ -381,23 +613,43 @@ def _vm_interfaces(conn, uuid):
 
     return [interface(idx, i) for idx, i in enumerate(elements)]
 
+
+def _vm_interfaces(conn, uuid):
+    return _interfaces(DomainSnapshot.by_uuid(conn, uuid))
+
 vm_interfaces = vm_method(_vm_interfaces)
 
 
 @vm_method
-def metrics(conn):
+def metrics(conn, with_errors=False):
+    """
+    Return metrics of the running VMs keyed by UUID. VMs are sampled
+    concurrently ('metrics-workers' threads), each within 'metrics-timeout'
+    seconds. With with_errors, return a dictionary with the collected
+    'metrics' and the UUIDs of VMs which 'failed' (with error messages) or
+    'timed_out'.
+    """
+    def report(res, failed=None, timed_out=None):
+        if with_errors:
+            return dict(metrics=res, failed=failed or {}, timed_out=timed_out or [])
+        return res
 
     if conn.getType() != 'OpenVZ':
-        return {}
+        return report({})
 
     def get_uuid(vm):
         return str(UUID(bytes=vm.UUID()))
 
-    def vm_metrics(vm):
+    def guest_metrics(vm):
+        """Sample a container from the inside, for containers the host-side
+        collector could not cover"""
         def cpu_usage():
             time_list_now = map(int, execute("vzctl exec %s \"head -n 1 /proc/stat\"" % vm.ID()).split(' ')[2:6])
-            time_list_was = roll_data('/tmp/func-cpu-%s' % vm.ID(), time_list_now, [0] * 6)
-            deltas = [yi - xi for yi, xi in zip(time_list_now, time_list_was)]
+            store.add(str(vm.ID()), 'guest-cpu', time_list_now)
+            delta = store.delta(str(vm.ID()), 'guest-cpu', window)
+            if delta is None:
+                return 0
+            deltas = delta[1]
             try:
                 cpu_pct = 1 - (float(deltas[-1]) / sum(deltas))
             except ZeroDivisionError:
@@ -415,11 +667,8 @@ def metrics(conn):
                 return [int(v) for v in execute("vzctl exec %s \"cat /proc/net/dev|grep venet0 | awk -F: '{print \$2}' | awk '{print \$1, \$9}'\""
                                                 % vm.ID()).split(' ')]
 
-            t2, (rx2, tx2) = time.time(), get_netstats()
-            t1, rx1, tx1 = roll_data("/tmp/func-network-%s" % vm.ID(), (t2, rx2, tx2), (0, 0, 0))
-
-            window = t2 - t1
-            return ((rx2 - rx1) / window, (tx2 - tx1) / window)
+            store.add(str(vm.ID()), 'guest-network', get_netstats())
+            return store.rates(str(vm.ID()), 'guest-network', window) or (0, 0)
 
         def diskspace_usage():
             return float(execute("vzctl exec %s \"df -P |grep ' /\$' | head -n 1 | awk '{print \$3/1024}'\"" % vm.ID()))
@@ -429,10 +678,38 @@ def metrics(conn):
                     memory_usage=memory_usage(),
                     network_usage=max(network_usage()),
                     diskspace_usage=diskspace_usage())
+    window = config.cget('general', 'metrics-window')
+    window = float(window) if window else None
+    host_metrics = vzmetrics.collect(window)
+
+    def vm_metrics(vm):
+        ctid = str(vm.ID())
+        if ctid in host_metrics:
+            return host_metrics[ctid]
+        return guest_metrics(vm)
+
     try:
-        return dict((get_uuid(vm), vm_metrics(vm)) for vm in (conn.lookupByID(i) for i in conn.listDomainsID()))
+        vms = dict((get_uuid(vm), vm) for vm in (conn.lookupByID(i) for i in conn.listDomainsID()))
     except libvirt.libvirtError:
-        return {}
+        return report({})
+
+    timeout = config.cget('general', 'metrics-timeout')
+    res, failed, timed_out = run_concurrently(lambda uuid: vm_metrics(vms[uuid]), vms.keys(),
+                                              int(config.cget('general', 'metrics-workers', 8)),
+                                              float(timeout) if timeout else None)
+    return report(res, failed, timed_out)
+
+
+@vm_method
+def metrics_history(conn, uuid, metric='cpu', count=None):
+    """
+    Return recent samples of a VM metric as a list of (timestamp, values),
+    oldest first. Metrics are raw counters: 'cpu' (used, uptime) jiffies and
+    'network' (input, output) bytes.
+    """
+    if conn.getType() != 'OpenVZ':
+        return []
+    return store.history(conn.lookupByUUIDString(uuid).name(), metric, count)
 
 
 def get_module(vm_type):
@@ -442,7 +719,9 @@ def get_module(vm_type):
         raise NotImplementedError("VM type '%s' is not (yet) supported" % vm_type)
 
 
-def _deploy_vm(vm_parameters, logger=None):
+def _get_deploy_settings(vm_parameters, logger=None):
+    """Return (vm module, storage pool, template settings adjusted to the
+    system resources) for deploying VMs with the given parameters"""
     from opennode.cli import actions
 
     storage_pool = actions.storage.get_default_pool()
@@ -472,8 +751,110 @@ def _deploy_vm(vm_parameters, logger=None):
         if logger:
             logger("Got %s" % (errors,))
         raise  Exception("got errors %s" % (errors,))
+    return vm, storage_pool, template_settings
 
-    vm.deploy(template_settings, storage_pool)
+
+def _deploy_vm(vm_parameters, logger=None):
+    vm, storage_pool, template_settings = _get_deploy_settings(vm_parameters, logger)
+    timings = vm.deploy(template_settings, storage_pool)
+    if logger and timings:
+        logger("Deployment timings: %s" % ', '.join("%s %.2fs" % t for t in timings))
+
+
+def _check_overrides(settings, override):
+    """Check per VM overrides of a batch deployment against the resource
+    limits (<key>_min and <key>_max settings) of the template"""
+    errors = []
+    for key, value in override.items():
+        minvalue, maxvalue = settings.get('%s_min' % key), settings.get('%s_max' % key)
+        try:
+            if minvalue is not None and float(value) < float(minvalue):
+                errors.append("%s %s is below the required minimum %s" % (key, value, minvalue))
+            if maxvalue is not None and float(value) > float(maxvalue):
+                errors.append("%s %s exceeds the available %s" % (key, value, maxvalue))
+        except (TypeError, ValueError):
+            errors.append("Invalid %s: %s" % (key, value))
+    return errors
+
+
+def _duplicates(values):
+    return sorted(set(v for v in values if values.count(v) > 1))
+
+
+def _check_batch(vm, vm_settings):
+    """Check that VMs of a batch don't share a hostname, an IP address or (for
+    KVM) a disk and that they fit within the host memory (and disk space, for
+    OpenVZ) together"""
+    errors = []
+    for key in ("hostname", "ip_address"):
+        values = [settings.get(key) for settings in vm_settings if settings.get(key)]
+        duplicates = _duplicates(values)
+        if duplicates:
+            errors.append("Duplicate %s: %s" % (key, ', '.join(map(str, duplicates))))
+    if vm is kvm:
+        # disk images are named after the hostname of the VM
+        if not all(settings.get("hostname") for settings in vm_settings):
+            errors.append("Every KVM VM of a batch needs a hostname")
+        devices = [disk["source_dev"] for settings in vm_settings
+                   for disk in settings["disks"] if disk["deploy_type"] in ("physical", "lvm")]
+        duplicates = _duplicates(devices)
+        if duplicates:
+            errors.append("VMs would share block devices: %s" % ', '.join(duplicates))
+    memory = sum(float(settings["memory"]) for settings in vm_settings)
+    available = sysres.get_ram_size_gb()
+    if memory > available:
+        errors.append("Requested memory %sGB exceeds available memory %sGB" %
+                      (memory, available))
+    if vm is openvz:
+        disk = sum(float(settings["disk"]) for settings in vm_settings)
+        available = sysres.get_disc_space_gb()
+        if disk > available:
+            errors.append("Requested disk space %sGB exceeds available %sGB" %
+                          (disk, available))
+    return errors
+
+
+def _deploy_vms(vm_parameters, overrides, workers=None):
+    vm, storage_pool, base_settings = _get_deploy_settings(vm_parameters)
+    if workers is None:
+        workers = int(config.cget('general', 'deploy-workers', 4))
+
+    vm_settings = []
+    for override in overrides:
+        settings = copy.deepcopy(base_settings)
+        if vm is openvz and "vm_id" not in override:
+            # the CTID is reserved by each deploy, right before it is used
+            del settings["vm_id"]
+        settings.update(override)
+        vm_settings.append(settings)
+    errors = _check_batch(vm, vm_settings)
+    if errors:
+        raise Exception("got errors %s" % (errors,))
+    if vm is openvz:
+        # link the template once, before any container is created
+        openvz.link_template(storage_pool, base_settings["template_name"])
+
+    def deploy_one(i):
+        settings = vm_settings[i]
+        errors = _check_overrides(settings, overrides[i])
+        if errors:
+            raise Exception("got errors %s" % (errors,))
+        if vm is openvz:
+            return vm.deploy(settings, storage_pool, link=False)
+        return vm.deploy(settings, storage_pool)
+
+    results, failures, timed_out = run_concurrently(deploy_one, range(len(vm_settings)),
+                                                    workers)
+    res = []
+    for i, settings in enumerate(vm_settings):
+        vm_result = dict((key, settings[key]) for key in ("hostname", "vm_id")
+                         if settings.get(key) is not None)
+        if i in results:
+            vm_result.update(status='OK', timings=results[i] or [])
+        else:
+            vm_result.update(status='error', error=failures.get(i))
+        res.append(vm_result)
+    return res
 
 
 def _get_running_vm_ids(conn):
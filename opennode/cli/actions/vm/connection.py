@@ -0,0 +1,88 @@
+"""Persistent libvirt connections shared by all modules talking to libvirtd"""
+
+import threading
+
+import libvirt
+
+
+class ConnectionPool(object):
+    """Keeps a single open libvirt connection per URI. Connections are
+    health-checked with isAlive() on every checkout and transparently reopened
+    when libvirtd went away."""
+
+    def __init__(self):
+        self._connections = {}
+        self._lock = threading.RLock()
+        self.counters = {'opens': 0, 'reuses': 0, 'reconnects': 0}
+
+    def get(self, uri, on_open=None):
+        """Return an open connection to the URI. on_open(conn) is called each
+        time a new connection had to be established"""
+        with self._lock:
+            conn = self._connections.get(uri)
+            if conn is not None:
+                if self.is_alive(conn):
+                    self.counters['reuses'] += 1
+                    return conn
+                self._close(uri)
+                self.counters['reconnects'] += 1
+            conn = libvirt.open(uri)
+            self.counters['opens'] += 1
+            self._connections[uri] = conn
+            if on_open is not None:
+                on_open(conn)
+            return conn
+
+    def discard(self, uri, conn=None, close=True):
+        """Drop the pooled connection (only if it is still conn, when given).
+        With close=False the connection is left open for its current users."""
+        with self._lock:
+            if conn is None or self._connections.get(uri) is conn:
+                if close:
+                    self._close(uri)
+                else:
+                    self._connections.pop(uri, None)
+
+    def clear(self):
+        """Close all pooled connections"""
+        with self._lock:
+            for uri in self._connections.keys():
+                self._close(uri)
+
+    def uri_of(self, conn):
+        """Return the URI the pooled connection was opened for"""
+        with self._lock:
+            for uri, pooled in self._connections.items():
+                if pooled is conn:
+                    return uri
+
+    def is_alive(self, conn):
+        """Return True if the libvirt connection can still be used"""
+        try:
+            return conn.isAlive() == 1
+        except AttributeError:
+            # libvirt < 0.9.8 has no isAlive, fall back to a cheap call
+            try:
+                conn.getType()
+                return True
+            except libvirt.libvirtError:
+                return False
+        except libvirt.libvirtError:
+            return False
+
+    def stats(self):
+        with self._lock:
+            res = dict(self.counters)
+            res['open_connections'] = len(self._connections)
+            return res
+
+    def _close(self, uri):
+        conn = self._connections.pop(uri, None)
+        if conn is not None:
+            try:
+                conn.close()
+            except libvirt.libvirtError:
+                pass
+
+
+pool = ConnectionPool()
@@ -0,0 +1,143 @@
+"""
+Allocation of OpenVZ container IDs.
+
+IDs in use are tracked in a bitmap built from the CT configs in /etc/vz/conf,
+rebuilt only when the folder changes. IDs handed out to deployments which have
+not created their container yet are reserved in a file shared by all processes
+(TUI, func, OMS calls) under an exclusive lock. Reservations expire, and are
+dropped early if the reserving process is gone.
+"""
+
+import fcntl
+import json
+import os
+import threading
+import time
+
+from opennode.cli import config
+from opennode.cli.actions.utils import atomic_write, mkdir_p, is_process_alive, MTIME_GRACE
+
+
+CONF_DIR = '/etc/vz/conf'
+DEFAULT_RESERVATIONS = '/var/spool/opennode/ctid-reservations'
+DEFAULT_TTL = 600
+# IDs up to 100 are reserved by OpenVZ
+FIRST_CTID = 101
+
+
+class CTIDAllocator(object):
+
+    def __init__(self, fnm, conf_dir=CONF_DIR):
+        self.fnm = fnm
+        self.lock_fnm = "%s.lock" % fnm
+        self.conf_dir = conf_dir
+        self._bitmap = bytearray()
+        self._bitmap_mtime = None
+        self._mutex = threading.Lock()
+
+    def _lock(self):
+        mkdir_p(os.path.dirname(os.path.abspath(self.fnm)))
+        fd = os.open(self.lock_fnm, os.O_RDWR | os.O_CREAT, 0644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def _used(self):
+        """Return bitmap of IDs having a CT config, rebuilt if the folder changed"""
+        try:
+            mtime = os.stat(self.conf_dir).st_mtime
+        except OSError:
+            return bytearray()
+        if mtime != self._bitmap_mtime:
+            ctids = []
+            for fnm in os.listdir(self.conf_dir):
+                name, ext = os.path.splitext(fnm)
+                if ext == '.conf' and name.isdigit():
+                    ctids.append(int(name))
+            bitmap = bytearray(max(ctids) + 1 if ctids else 0)
+            for ctid in ctids:
+                bitmap[ctid] = 1
+            self._bitmap = bitmap
+            # with coarse mtimes a config created within the same second would
+            # go unnoticed, such a folder is rescanned on the next call
+            self._bitmap_mtime = mtime if time.time() - mtime > MTIME_GRACE else None
+        return self._bitmap
+
+    def _load(self):
+        """Return live reservations as {ctid: (expires, pid)}"""
+        try:
+            with open(self.fnm) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        now = time.time()
+        reservations = {}
+        for ctid, (expires, pid) in data.items():
+            if expires > now and is_process_alive(pid):
+                reservations[int(ctid)] = (expires, pid)
+        return reservations
+
+    def _save(self, reservations):
+        atomic_write(self.fnm, json.dumps(dict((str(ctid), list(r))
+                                               for ctid, r in reservations.items())))
+
+    def _is_free(self, ctid, used, reservations):
+        return (ctid >= len(used) or not used[ctid]) and ctid not in reservations
+
+    def _first_free(self, used, reservations):
+        ctid = FIRST_CTID
+        while not self._is_free(ctid, used, reservations):
+            ctid += 1
+        return ctid
+
+    def peek(self):
+        """Return the ID the next reservation would get, without reserving it"""
+        with self._mutex:
+            fd = self._lock()
+            try:
+                return self._first_free(self._used(), self._load())
+            finally:
+                os.close(fd)
+
+    def reserve(self, ctid=None, ttl=None):
+        """Reserve and return an ID for a new container, ctid if it is free
+        or the lowest free one otherwise. The reservation lasts until the
+        container is created and released, or for ttl seconds."""
+        if ttl is None:
+            ttl = int(config.cget('general', 'ctid-reservation-ttl', DEFAULT_TTL))
+        with self._mutex:
+            fd = self._lock()
+            try:
+                used, reservations = self._used(), self._load()
+                if ctid is None or int(ctid) < FIRST_CTID or \
+                        not self._is_free(int(ctid), used, reservations):
+                    ctid = self._first_free(used, reservations)
+                ctid = int(ctid)
+                reservations[ctid] = (time.time() + ttl, os.getpid())
+                self._save(reservations)
+                return ctid
+            finally:
+                os.close(fd)
+
+    def release(self, ctid):
+        """Drop a reservation, once the container exists or its deployment failed"""
+        with self._mutex:
+            fd = self._lock()
+            try:
+                reservations = self._load()
+                if reservations.pop(int(ctid), None) is not None:
+                    self._save(reservations)
+            finally:
+                os.close(fd)
+
+
+_allocators = {}
+_allocators_lock = threading.Lock()
+
+
+def get_allocator(fnm=None):
+    if fnm is None:
+        fnm = config.cget('general', 'ctid-reservations', DEFAULT_RESERVATIONS)
+    with _allocators_lock:
+        if fnm not in _allocators:
+            _allocators[fnm] = CTIDAllocator(fnm)
+        return _allocators[fnm]
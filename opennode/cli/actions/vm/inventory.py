@@ -0,0 +1,190 @@
+"""In-memory VM inventory kept up to date by libvirt domain lifecycle events"""
+
+import threading
+import time
+
+import libvirt
+
+from opennode.cli.actions.vm.connection import pool
+
+
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def _start_event_loop():
+    """Register the default libvirt event implementation and run it in a daemon
+    thread. Connections opened before this call do not deliver events."""
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is not None:
+            return
+        libvirt.virEventRegisterDefaultImpl()
+
+        def run():
+            while True:
+                libvirt.virEventRunDefaultImpl()
+
+        _event_loop = threading.Thread(target=run, name='libvirt-events')
+        _event_loop.setDaemon(True)
+        _event_loop.start()
+
+
+class InventoryCache(object):
+    """
+    Rendered VMs of a single libvirt URI served from memory.
+
+    Entries are (vm, used_memory_kb) tuples produced by load_all(conn), which
+    returns them keyed by UUID, and load_one(conn, dom). Lifecycle events mark
+    single domains for reloading on the next read; a full reload happens every
+    reconcile_interval seconds as a safety net. Drivers without event support
+    (e.g. OpenVZ) can't be cached, see has_events.
+
+    The cache owns its connection, opened after the event loop was started so
+    that it delivers events, and closes it when it has to be replaced.
+    """
+
+    def __init__(self, uri, load_all, load_one, reconcile_interval):
+        self.uri = uri
+        self.load_all = load_all
+        self.load_one = load_one
+        self.reconcile_interval = reconcile_interval
+        self.entries = {}
+        self.events = None  # unknown until connected
+        self._conn = None
+        self._dirty = set()
+        self._removed = set()
+        self._last_reconcile = 0
+        # _lock guards the state shared with the event callback and is never
+        # held while talking to libvirt, _refresh_lock serializes reloads
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+
+    def _connect(self):
+        conn = self._conn
+        if conn is not None and pool.is_alive(conn):
+            return conn
+        self.close()
+        # new or reestablished connection, event callbacks have to be registered again
+        conn = libvirt.open(self.uri)
+        try:
+            conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                        self._on_event, None)
+            self.events = True
+        except (libvirt.libvirtError, AttributeError):
+            self.events = False
+        with self._lock:
+            self._conn = conn
+            self._last_reconcile = 0
+        return conn
+
+    def close(self):
+        """Close the connection of the cache"""
+        with self._lock:
+            conn, self._conn = self._conn, None
+        if conn is not None:
+            try:
+                conn.close()
+            except libvirt.libvirtError:
+                pass
+
+    def has_events(self):
+        """Return True if the driver delivers lifecycle events, which the cache
+        relies on. The connection is dropped for drivers which don't."""
+        with self._refresh_lock:
+            if self.events is None:
+                self._connect()
+                if not self.events:
+                    self.close()
+            return self.events
+
+    def _on_event(self, conn, dom, event, detail, opaque):
+        uuid = dom.UUIDString()
+        with self._lock:
+            if event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+                self._dirty.discard(uuid)
+                self._removed.add(uuid)
+            else:
+                self._removed.discard(uuid)
+                self._dirty.add(uuid)
+
+    def invalidate(self, uuid=None):
+        """Reload a single domain (or everything) on the next read"""
+        with self._lock:
+            if uuid is None:
+                self._last_reconcile = 0
+            else:
+                self._dirty.add(uuid)
+
+    def refresh(self):
+        with self._refresh_lock:
+            conn = self._connect()
+            with self._lock:
+                full = time.time() - self._last_reconcile > self.reconcile_interval
+                if full:
+                    # events from now on are applied on top of the full load
+                    self._dirty.clear()
+                    self._removed.clear()
+            if full:
+                entries = self.load_all(conn)
+                with self._lock:
+                    self.entries = entries
+                    self._last_reconcile = time.time()
+            with self._lock:
+                dirty, removed = self._dirty, self._removed
+                self._dirty, self._removed = set(), set()
+            loaded = {}
+            for uuid in dirty:
+                try:
+                    loaded[uuid] = self.load_one(conn, conn.lookupByUUIDString(uuid))
+                except libvirt.libvirtError:
+                    # undefined before we got to it
+                    removed.add(uuid)
+            with self._lock:
+                entries = dict(self.entries)
+                entries.update(loaded)
+                for uuid in removed:
+                    entries.pop(uuid, None)
+                self.entries = entries
+
+    def list(self):
+        """Return rendered VMs"""
+        self.refresh()
+        with self._lock:
+            return [dict(vm) for vm, _ in self.entries.values()]
+
+    def get(self, uuid):
+        """Return a rendered VM or None if it is not known"""
+        self.refresh()
+        with self._lock:
+            if uuid not in self.entries:
+                return None
+            return dict(self.entries[uuid][0])
+
+    def used_memory(self):
+        """Return memory (in KB) used by the running VMs"""
+        self.refresh()
+        with self._lock:
+            return sum(mem for _, mem in self.entries.values())
+
+
+def get_cache(uri, load_all, load_one, reconcile_interval):
+    """Return the inventory cache of the URI, creating it on the first use"""
+    with _caches_lock:
+        cache = _caches.get(uri)
+        if cache is None:
+            _start_event_loop()
+            cache = InventoryCache(uri, load_all, load_one, reconcile_interval)
+            _caches[uri] = cache
+        cache.reconcile_interval = reconcile_interval
+        return cache
+
+
+def close_all():
+    """Close connections of all inventory caches"""
+    with _caches_lock:
+        for cache in _caches.values():
+            cache.close()
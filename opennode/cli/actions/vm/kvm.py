@@ -6,14 +6,13 @@ import operator
 import tarfile
 from contextlib import closing
 
-import libvirt
-
 from ovf.OvfFile import OvfFile
 from ovf.OvfReferencedFile import OvfReferencedFile
 
 from opennode.cli import config
 from opennode.cli.actions.utils import execute, get_file_size_bytes, calculate_hash, TemplateException
 from opennode.cli.actions.vm import ovfutil
+from opennode.cli.actions.vm.connection import pool
 from opennode.cli.actions import sysresources as sysres
 
 
@@ -62,7 +61,7 @@ def get_active_template_settings(vm_name, storage_pool):
 
 
 def get_libvirt_conf_xml(vm_name):
-    conn = libvirt.open("qemu:///system")
+    conn = pool.get("qemu:///system")
     vm = conn.lookupByName(vm_name)
     document = xml.dom.minidom.parseString(vm.XMLDesc(0))
     return document
@@ -130,7 +129,7 @@ def deploy(settings, storage_pool):
     libvirt_conf_dom = generate_libvirt_conf(settings)
 
     print "Finalyzing KVM template deployment..."
-    conn = libvirt.open("qemu:///system")
+    conn = pool.get("qemu:///system")
     conn.defineXML(libvirt_conf_dom.toxml())
     print "Done!"
 
@@ -149,8 +148,12 @@ def prepare_file_system(settings, storage_pool):
     for disk in settings["disks"]:
         disk_template_path = path.join(target_dir, disk["template_name"])
         if disk["deploy_type"] == "file":
-            disk_deploy_path = path.join(images_dir, settings["vm_type"] + "-" + disk["source_file"])
+            # every VM gets its own copy, also VMs of the same template deployed together
+            disk_deploy_path = path.join(images_dir, "%s-%s-%s" % (settings["vm_type"],
+                                                                   settings["hostname"],
+                                                                   disk["source_file"]))
             shutil.copy2(disk_template_path, disk_deploy_path)
+            disk["deploy_path"] = disk_deploy_path
         elif disk["deploy_type"] in ["physical", "lvm"]:
             disk_deploy_path = disk["source_dev"]
             execute("qemu-img convert -f qcow2 -O raw %s %s" % (disk_template_path, disk_deploy_path))
@@ -181,7 +184,7 @@ def adjust_setting_to_systems_resources(ovf_template_settings):
 
 def get_available_instances():
     """Return a list of defined KVM VMs"""
-    conn = libvirt.open("qemu:///system")
+    conn = pool.get("qemu:///system")
     name_list = conn.listDefinedDomains()
     return dict(zip(name_list, name_list))
 
@@ -272,9 +275,7 @@ def generate_libvirt_conf(settings):
             disk_dom.setAttribute("device", disk["device"])
             devices_dom.appendChild(disk_dom)
             disk_source_dom = libvirt_conf_dom.createElement("source")
-            image_path = path.join(config.c("general", "storage-endpoint"), config.c("general", "default-storage-pool"), "images")
-            disk_source_dom.setAttribute("file", path.join(image_path,
-                                                           "%s-%s" % (settings["vm_type"], disk["source_file"])))
+            disk_source_dom.setAttribute("file", disk["deploy_path"])
             disk_dom.appendChild(disk_source_dom)
             disk_target_dom = libvirt_conf_dom.createElement("target")
             disk_target_dom.setAttribute("dev", disk["target_dev"])
@@ -5,9 +5,8 @@ import tarfile
 from os import path
 from hashlib import sha1
 import errno
-from contextlib import closing
-
-import libvirt
+from contextlib import closing, contextmanager
+import time
 
 from ovf.OvfFile import OvfFile
 from ovf.OvfReferencedFile import OvfReferencedFile
@@ -15,21 +14,26 @@ from ovf.OvfReferencedFile import OvfReferencedFile
 from opennode.cli import config
 from opennode.cli.actions import sysresources as sysres
 from opennode.cli.actions.vm import ovfutil
+from opennode.cli.actions.vm.ctid import get_allocator as get_ctid_allocator
+from opennode.cli.actions.vm.connection import pool
 from opennode.cli.actions import oms
 from opennode.cli.actions.utils import SimpleConfigParser, execute, get_file_size_bytes, \
-                        calculate_hash, CommandException, TemplateException, test_passwordless_ssh, execute2
+                        calculate_hash, CommandException, TemplateException, test_passwordless_ssh, execute2, \
+                        atomic_write
 from opennode.cli.actions.vm.config_template import openvz_template
 from opennode.cli.actions.network import list_nameservers
 import shutil
 import stat
 
 
-def get_ovf_template_settings(ovf_file):
-    """ Parses ovf file and creates a dictionary of settings """
+def get_ovf_template_settings(ovf_file, with_ct_id=True):
+    """ Parses ovf file and creates a dictionary of settings. With with_ct_id
+    the next available CTID is included as vm_id. """
     settings = read_default_ovf_settings()
     ovf_settings = read_ovf_settings(ovf_file)
     settings.update(ovf_settings)
-    settings["vm_id"] = _get_available_ct_id()
+    if with_ct_id:
+        settings["vm_id"] = _get_available_ct_id()
     return settings
 
 
@@ -139,23 +143,13 @@ def adjust_setting_to_systems_resources(ovf_template_settings):
 
 def _get_available_ct_id():
     """
-    Get next available IF for new OpenVZ CT
+    Get next available IF for new OpenVZ CT. The ID is not reserved, deploy
+    reserves it (or the next free one, if it got taken meanwhile).
 
     @return: Next available ID for new OpenVZ CT
     @rtype: Integer
     """
-    return max(100, max([0] + _get_openvz_ct_id_list())) + 1
-
-
-def _get_openvz_ct_id_list():
-    """
-    Return a list of current OpenVZ CTs (both running and stopped)
-
-    @return: List of OpenVZ containers on current machine
-    @rtype: List
-    """
-    existing = [ctid.strip() for ctid in execute("vzlist --all -H -o ctid").splitlines()]
-    return map(int, existing)
+    return get_ctid_allocator().peek()
 
 
 def _compute_diskspace_hard_limit(soft_limit):
@@ -214,17 +208,33 @@ def create_container(ovf_settings):
                                                            ovf_settings["vm_id"]))
     # replace ostemplate with a provided value, as vzctl sets the filename
     # of the packaged template, which is in general not reliable
-    execute("sed -i 's/OSTEMPLATE=\"%s\"/OSTEMPLATE=\"%s\"/' %s" % (ovf_settings["template_name"],
-                                                           ovf_settings["ostemplate"],
-                                                           "/etc/vz/conf/%s.conf" % ovf_settings["vm_id"]
-                                                           )
-            )
-    execute("chmod 755 /vz/private/%s" % ovf_settings["vm_id"])
+    ct_conf_fnm = "/etc/vz/conf/%s.conf" % ovf_settings["vm_id"]
+    with open(ct_conf_fnm) as f:
+        ct_conf = f.read()
+    atomic_write(ct_conf_fnm, ct_conf.replace('OSTEMPLATE="%s"' % ovf_settings["template_name"],
+                                              'OSTEMPLATE="%s"' % ovf_settings["ostemplate"]))
+    os.chmod(ct_conf_fnm, 0644)
+    os.chmod("/vz/private/%s" % ovf_settings["vm_id"], 0755)
     # unlink base config
     base_config = os.path.join('/etc/vz/conf/', "ve-%s.conf-sample" % ovf_settings["vm_id"])
     os.unlink(base_config)
 
 
+def apply_settings(ovf_settings):
+    """Apply network, hostname, root password and onboot settings of a new
+    container in a single vzctl call, saving the CT config only once"""
+    nameservers = ovf_settings.get("nameservers", None)
+    if not nameservers:
+        nameservers = [ovf_settings["nameserver"]]
+    options = ['--nameserver %s' % i for i in nameservers]
+    options.append("--ipadd %s" % ovf_settings["ip_address"])
+    options.append("--hostname %s" % ovf_settings["hostname"])
+    options.append("--userpasswd root:%s" % ovf_settings["passwd"])
+    if ovf_settings.get("onboot", 0) == 1:
+        options.append("--onboot yes")
+    execute("vzctl set %s %s --save" % (ovf_settings["vm_id"], ' '.join(options)))
+
+
 def setup_scripts(vm_settings, storage_pool):
     """Setup action scripts for the CT"""
     dest_dir = path.join(config.c('general', 'storage-endpoint'), storage_pool, "openvz")
@@ -253,43 +263,62 @@ def generate_config(ovf_settings):
     target_conf_fnm = os.path.join('/etc/vz/conf/', "ve-%s.conf-sample" % ovf_settings["vm_id"])
     with open(target_conf_fnm, 'w') as conf_file:
         conf_file.write(openvz_ct_conf)
-    execute("chmod 644 %s" % target_conf_fnm)
+    os.chmod(target_conf_fnm, 0644)
+
 
+@contextmanager
+def _timed(timings, step):
+    """Record duration of a deployment step as (step, seconds)"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings.append((step, time.time() - start))
 
-def deploy(ovf_settings, storage_pool):
-    """ Deploys OpenVZ container """
+
+def deploy(ovf_settings, storage_pool, link=True):
+    """ Deploys OpenVZ container. Return a list of (step, seconds) timings.
+    Batch deployments link the template once themselves, passing link=False """
+    timings = []
     # make sure we have required template present and symlinked
-    link_template(storage_pool, ovf_settings["template_name"])
+    if link:
+        with _timed(timings, 'link template'):
+            link_template(storage_pool, ovf_settings["template_name"])
 
-    print "Generating configuration..."
-    generate_config(ovf_settings)
+    # reserve the ID for the container, until vzctl create makes it taken
+    with _timed(timings, 'reserve ctid'):
+        ovf_settings["vm_id"] = get_ctid_allocator().reserve(ovf_settings.get("vm_id"))
+    try:
+        print "Generating configuration..."
+        with _timed(timings, 'generate config'):
+            generate_config(ovf_settings)
 
-    print "Creating OpenVZ container..."
-    create_container(ovf_settings)
+        print "Creating OpenVZ container..."
+        with _timed(timings, 'create container'):
+            create_container(ovf_settings)
+    finally:
+        get_ctid_allocator().release(ovf_settings["vm_id"])
 
     print "Deploying..."
-    nameservers = ovf_settings.get("nameservers", None)
-    if not nameservers:
-        nameservers = [ovf_settings["nameserver"]]
-
-    execute("vzctl set %s %s --save" % (ovf_settings["vm_id"], ' '.join('--nameserver %s' % i for i in nameservers)))
-    execute("vzctl set %s --ipadd %s --save" % (ovf_settings["vm_id"], ovf_settings["ip_address"]))
-    execute("vzctl set %s --hostname %s --save" % (ovf_settings["vm_id"], ovf_settings["hostname"]))
-    execute("vzctl set %s --userpasswd root:%s --save" % (ovf_settings["vm_id"], ovf_settings["passwd"]))
+    with _timed(timings, 'apply settings'):
+        apply_settings(ovf_settings)
 
     print "Setting up action scripts..."
-    setup_scripts(ovf_settings, storage_pool)
+    with _timed(timings, 'setup scripts'):
+        setup_scripts(ovf_settings, storage_pool)
 
     if ovf_settings.get('appliance_type') == 'oms':
-        oms.configure_oms_vm(ovf_settings["vm_id"], ovf_settings["hostname"])
+        with _timed(timings, 'configure oms'):
+            oms.configure_oms_vm(ovf_settings["vm_id"], ovf_settings["hostname"])
 
     if ovf_settings.get("startvm", 0) == 1:
-        execute("vzctl start %s" % (ovf_settings["vm_id"]))
-
-    if ovf_settings.get("onboot", 0) == 1:
-        execute("vzctl set %s --onboot yes --save" % (ovf_settings["vm_id"]))
+        with _timed(timings, 'start'):
+            execute("vzctl start %s" % (ovf_settings["vm_id"]))
 
-    print "Template %s deployed successfully!" % ovf_settings["vm_id"]
+    print "Template %s deployed successfully in %.1fs (%s)" % (
+        ovf_settings["vm_id"], sum(t for _, t in timings),
+        ', '.join("%s %.1fs" % timing for timing in timings))
+    return timings
 
 
 def query_openvz(include_running=False, fields='ctid,hostname'):
@@ -304,6 +333,66 @@ def query_openvz(include_running=False, fields='ctid,hostname'):
     return result
 
 
+INVENTORY_FIELDS = ['ctid', 'hostname', 'ostemplate', 'privvmpages.l', 'physpages.l',
+                    'diskspace.h', 'swappages.l', 'status']
+# vzlist shows unset values as '-', only numeric ones are turned into None
+NUMERIC_INVENTORY_FIELDS = ['privvmpages.l', 'physpages.l', 'diskspace.h', 'swappages.l']
+
+
+def get_inventory(ctids=None):
+    """
+    Return parameters of all (or the given) containers as a table keyed by CTID,
+    using a single vzlist invocation and /proc/vz/vestat for uptimes.
+
+    @return: {ctid: {'hostname', 'template', 'memory', 'diskspace', 'swap',
+                     'status', 'uptime'}}, sizes in MB, uptime in seconds
+    @rtype: Dictionary
+    """
+    target = ' '.join(str(ctid) for ctid in ctids) if ctids else '-a'
+    try:
+        output = execute("vzlist -H -o %s %s" % (','.join(INVENTORY_FIELDS), target))
+    except CommandException:
+        # vzlist fails if no containers are found
+        return {}
+    uptimes = _read_vestat_uptimes()
+    inventory = {}
+    for line in output.splitlines():
+        row = line.split()
+        if len(row) != len(INVENTORY_FIELDS):
+            continue
+        values = dict(zip(INVENTORY_FIELDS, row))
+        for field in NUMERIC_INVENTORY_FIELDS:
+            if values[field] == '-':
+                values[field] = None
+        ctid = values['ctid']
+        inventory[ctid] = {'hostname': values['hostname'],
+                           'template': values['ostemplate'],
+                           'memory': _memory_mb(values['privvmpages.l'], values['physpages.l']),
+                           'diskspace': _diskspace_mb(values['diskspace.h']),
+                           'swap': _pages_to_mb(values['swappages.l']),
+                           'status': values['status'],
+                           'uptime': uptimes.get(ctid)}
+    return inventory
+
+
+def _read_vestat_uptimes(vestat='/proc/vz/vestat'):
+    """Return uptimes (in seconds) of running containers, keyed by CTID"""
+    uptimes = {}
+    try:
+        with open(vestat) as f:
+            lines = f.readlines()
+    except IOError:
+        return uptimes
+    hz = float(os.sysconf('SC_CLK_TCK'))
+    for line in lines:
+        # VEID user nice system uptime idle strv uptime used maxlat totlat numsched
+        cols = line.split()
+        if len(cols) < 5 or not cols[0].isdigit():
+            continue
+        uptimes[cols[0]] = int(cols[4]) / hz
+    return uptimes
+
+
 def get_available_instances():
     """Return deployed and stopped OpenVZ instances"""
     resources = query_openvz(False, "ctid,hostname")
@@ -500,22 +589,39 @@ def _generate_ovf_file(vm_settings, ct_archive_fnm):
     return ovf
 
 
+def _pages_to_mb(pages):
+    if pages is None:
+        return 0
+    return int(pages) * 4 / 1024
+
+
+def _memory_mb(privvmpages, physpages):
+    res = _pages_to_mb(privvmpages)
+    if res >= 2 ** 31:
+        res = _pages_to_mb(physpages)
+    return res
+
+
+def _diskspace_mb(diskspace):
+    if diskspace is None:
+        return 0.0
+    return float(diskspace) / 1024
+
+
 def get_swap(ctid):
     """Swap memory in MB"""
-    return int(execute("vzlist %s -H -o swappages.l" % ctid)) * 4 / 1024
+    return _pages_to_mb(execute("vzlist %s -H -o swappages.l" % ctid))
 
 
 def get_memory(ctid):
     """Max memory in MB"""
-    res = int(execute("vzlist %s -H -o privvmpages.l" % ctid)) * 4 / 1024
-    if res >= 2 ** 31:
-        res = int(execute("vzlist %s -H -o physpages.l" % ctid)) * 4 / 1024
-    return res
+    privvmpages, physpages = execute("vzlist %s -H -o privvmpages.l,physpages.l" % ctid).split()
+    return _memory_mb(privvmpages, physpages)
 
 
 def get_diskspace(ctid):
     """Max disk space in MB"""
-    return float(execute("vzlist %s -H -o diskspace.h" % ctid)) / 1024
+    return _diskspace_mb(execute("vzlist %s -H -o diskspace.h" % ctid))
 
 
 def get_onboot(ctid):
@@ -589,7 +695,7 @@ def get_uuid_by_ctid(ctid):
 
 def get_ctid_by_uuid(uuid, backend='openvz:///system'):
     """Return container ID with a given UUID"""
-    conn = libvirt.open(backend)
+    conn = pool.get(backend)
     return conn.lookupByUUIDString(uuid).name()
 
 
@@ -0,0 +1,149 @@
+"""
+Host-side metrics of OpenVZ containers.
+
+All running containers are sampled in a single pass from the host kernel
+interfaces (/proc/vz/vestat, /proc/user_beancounters, /proc/vz/vznetstat) and
+one vzlist call, without entering the containers with vzctl exec.
+"""
+
+import os
+import time
+
+from opennode.cli.actions.utils import execute, CommandException
+from opennode.cli.actions.timeseries import store
+
+
+VESTAT = '/proc/vz/vestat'
+BEANCOUNTERS = '/proc/user_beancounters'
+VZNETSTAT = '/proc/vz/vznetstat'
+
+
+def _read_lines(fnm):
+    try:
+        with open(fnm) as f:
+            return f.readlines()
+    except IOError:
+        return None
+
+
+def read_vestat(fnm=VESTAT):
+    """Return {ctid: (used, uptime)} CPU time counters in jiffies"""
+    lines = _read_lines(fnm)
+    if lines is None:
+        return {}
+    res = {}
+    for line in lines:
+        # VEID user nice system uptime idle strv uptime used maxlat totlat numsched
+        cols = line.split()
+        if len(cols) < 5 or not cols[0].isdigit():
+            continue
+        user, nice, system, uptime = map(int, cols[1:5])
+        res[cols[0]] = (user + nice + system, uptime)
+    return res
+
+
+def read_beancounters(resource, fnm=BEANCOUNTERS):
+    """Return {ctid: held} of a user beancounter resource"""
+    lines = _read_lines(fnm)
+    if lines is None:
+        return {}
+    res = {}
+    ctid = None
+    for line in lines:
+        cols = line.split()
+        if not cols:
+            continue
+        if cols[0].endswith(':'):
+            ctid = cols[0][:-1]
+            cols = cols[1:]
+        if ctid is not None and len(cols) >= 2 and cols[0] == resource:
+            res[ctid] = int(cols[1])
+    return res
+
+
+def read_vznetstat(fnm=VZNETSTAT):
+    """Return {ctid: (input_bytes, output_bytes)} summed over all traffic classes"""
+    lines = _read_lines(fnm)
+    if lines is None:
+        return {}
+    res = {}
+    for line in lines:
+        # VEID Net.Class Input(bytes) Input(pkts) Output(bytes) Output(pkts)
+        cols = line.split()
+        if len(cols) < 5 or not cols[0].isdigit():
+            continue
+        rx, tx = res.get(cols[0], (0, 0))
+        res[cols[0]] = (rx + int(cols[2]), tx + int(cols[4]))
+    return res
+
+
+def read_vzlist():
+    """Return {ctid: (load, diskspace_kb, cpus)} of the running containers"""
+    try:
+        output = execute("vzlist -H -o ctid,laverage,diskspace,cpus")
+    except CommandException:
+        # vzlist fails if no containers are running
+        return {}
+    res = {}
+    for line in output.splitlines():
+        cols = line.split()
+        if len(cols) != 4:
+            continue
+        ctid, laverage, diskspace, cpus = cols
+        load = float(laverage.split('/')[0]) if laverage != '-' else 0.0
+        diskspace = int(diskspace) if diskspace != '-' else 0
+        cpus = int(cpus) if cpus.isdigit() else None
+        res[ctid] = (load, diskspace, cpus)
+    return res
+
+
+def collect(window=None):
+    """
+    Return metrics of all running containers, keyed by CTID, in the format of
+    vm.metrics: cpu_usage (0..1), load, memory_usage (MB), network_usage
+    (bytes/s, max of rx and tx) and diskspace_usage (MB). Containers missing
+    from any of the host-side sources are not included.
+
+    CPU time and traffic counters are recorded in the sample store under the
+    'cpu' and 'network' metrics of the CTID, rates are computed over the last
+    `window` seconds (all stored samples by default).
+    """
+    now = time.time()
+    vestat = read_vestat()
+    physpages = read_beancounters('physpages')
+    netstat = read_vznetstat()
+    vzlist = read_vzlist()
+    host_cpus = os.sysconf('SC_NPROCESSORS_ONLN')
+
+    # forget containers which are gone, only a successful vzlist run tells
+    # (it also fails when no containers are running)
+    if vzlist:
+        for ctid in store.keys() - set(vzlist):
+            if ctid.isdigit():
+                store.forget(ctid)
+
+    res = {}
+    for ctid in vzlist:
+        if ctid not in vestat or ctid not in netstat or ctid not in physpages:
+            continue
+        last = store.history(ctid, 'cpu', 1)
+        if last and vestat[ctid][1] < last[0][1][1]:
+            # container was restarted, counters start from zero again
+            store.forget(ctid)
+        store.add(ctid, 'cpu', vestat[ctid], now)
+        store.add(ctid, 'network', netstat[ctid], now)
+        load, diskspace, cpus = vzlist[ctid]
+
+        cpu_usage = 0
+        cpu_delta = store.delta(ctid, 'cpu', window)
+        if cpu_delta is not None:
+            used, uptime = cpu_delta[1]
+            if uptime > 0:
+                cpu_usage = min(1.0, max(0.0, float(used) / (uptime * (cpus or host_cpus))))
+
+        res[ctid] = dict(cpu_usage=cpu_usage,
+                         load=load,
+                         memory_usage=physpages[ctid] * 4 / 1024.0,
+                         network_usage=max(store.rates(ctid, 'network', window) or [0]),
+                         diskspace_usage=diskspace / 1024.0)
+    return res
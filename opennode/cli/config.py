@@ -1,5 +1,7 @@
 import ConfigParser
 import os
+import tempfile
+import threading
 
 config_path = '/etc/opennode/'
 
@@ -7,6 +9,12 @@ config_names = {'global': 'opennode-tui.conf',
            'openvz': 'openvz.conf',
            'kvm': 'kvm.conf'}
 
+# conf_type -> resolved filename
+_resolved_names = {}
+# filename -> ((st_ino, st_size, st_mtime), RawConfigParser)
+_cache = {}
+_lock = threading.RLock()
+
 
 def _resolve_conf_name(conf_type):
     """
@@ -22,32 +30,112 @@ def _resolve_conf_name(conf_type):
         raise RuntimeError("Missing configuration file for %s" % conf_type)
 
 
+def _stat_key(st):
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
+def _load(conf_type):
+    """
+    Return (filename, parser) of the configuration. The parsed file is cached
+    and only re-read when its inode, size or mtime changes, so that a lookup
+    costs a single stat call.
+    """
+    with _lock:
+        fnm = _resolved_names.get(conf_type)
+        try:
+            if fnm is None:
+                raise OSError
+            st = os.stat(fnm)
+        except OSError:
+            # not resolved yet or the file went away, look it up again
+            fnm = _resolved_names[conf_type] = _resolve_conf_name(conf_type)
+            st = os.stat(fnm)
+        cached = _cache.get(fnm)
+        if cached is not None and cached[0] == _stat_key(st):
+            return fnm, cached[1]
+        conf = ConfigParser.RawConfigParser()
+        conf.read(fnm)
+        _cache[fnm] = (_stat_key(st), conf)
+        return fnm, conf
+
+
+def _write(fnm, conf):
+    """Atomically replace the file with the contents of conf"""
+    dirname = os.path.dirname(os.path.abspath(fnm))
+    fd, tmp = tempfile.mkstemp(prefix='.%s.' % os.path.basename(fnm), dir=dirname)
+    try:
+        try:
+            os.fchmod(fd, os.stat(fnm).st_mode & 07777)
+        except OSError:
+            pass
+        with os.fdopen(fd, 'wb') as configfile:
+            conf.write(configfile)
+            configfile.flush()
+            os.fsync(configfile.fileno())
+        os.rename(tmp, fnm)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    _cache[fnm] = (_stat_key(os.stat(fnm)), conf)
+
+
+def signature(conf_type='global'):
+    """Return a string which changes whenever the configuration file changes"""
+    fnm = _load(conf_type)[0]
+    with _lock:
+        return ':'.join(map(str, _cache[fnm][0]))
+
+
+def invalidate():
+    """Drop all cached configuration, forcing a re-read on next access"""
+    with _lock:
+        _resolved_names.clear()
+        _cache.clear()
+
+
 def c(group, field, conf_type='global'):
     """Get configuration value"""
-    conf = ConfigParser.RawConfigParser()
-    conf.read(_resolve_conf_name(conf_type))
-    return conf.get(group, field)
+    return _load(conf_type)[1].get(group, field)
+
+
+def cget(group, field, default=None, conf_type='global'):
+    """Get configuration value, return default if the option is not set"""
+    conf = _load(conf_type)[1]
+    if conf.has_option(group, field):
+        return conf.get(group, field)
+    return default
 
 
 def cs(group, field, value, conf_type='global'):
     """Set configuration value"""
-    conf = ConfigParser.RawConfigParser()
-    fnm = _resolve_conf_name(conf_type)
-    conf.read(fnm)
-    conf.set(group, field, value)
-    with open(fnm, 'wb') as configfile:
-        conf.write(configfile)
+    cs_many([(group, field, value)], conf_type)
+
+
+def cs_many(values, conf_type='global'):
+    """
+    Set several configuration values, given as (group, field, value) tuples,
+    with a single write. The file is not touched if nothing changes.
+    """
+    with _lock:
+        fnm, conf = _load(conf_type)
+        changes = [(group, field, str(value)) for group, field, value in values
+                   if not conf.has_option(group, field) or conf.get(group, field) != str(value)]
+        if not changes:
+            return
+        # modify a fresh copy, so that the cache stays intact if writing fails
+        conf = ConfigParser.RawConfigParser()
+        conf.read(fnm)
+        for group, field, value in changes:
+            conf.set(group, field, value)
+        _write(fnm, conf)
 
 
 def clist(group, conf_type='global'):
     """List configuration values"""
-    conf = ConfigParser.RawConfigParser()
-    conf.read(_resolve_conf_name(conf_type))
-    return conf.items(group)
+    return _load(conf_type)[1].items(group)
 
 
 def has_option(group, field, conf_type='global'):
     """Return whether an option is available for that section"""
-    conf = ConfigParser.RawConfigParser()
-    conf.read(_resolve_conf_name(conf_type))
-    return conf.has_option(group, field)
+    return _load(conf_type)[1].has_option(group, field)
@@ -13,7 +13,7 @@ from opennode.cli import actions
 from opennode.cli import config
 from opennode.cli.forms import (KvmForm, OpenvzForm, OpenvzTemplateForm, KvmTemplateForm,
                                 OpenvzModificationForm, OpenVZMigrationForm)
-from opennode.cli.actions.utils import test_passwordless_ssh, setup_passwordless_ssh, TemplateException
+from opennode.cli.actions.utils import test_passwordless_ssh, setup_passwordless_ssh
 
 VERSION = '2.0.0a'
 TITLE = 'OpenNode TUI v%s' % VERSION
@@ -280,45 +280,47 @@ class OpenNodeTUI(object):
     def display_template_manage(self):
         # XXX Ugly structure, needs refactoring
         if actions.templates.is_syncing():
-            self.screen.finish()
-            actions.utils.attach_screen('OPENNODE-SYNC')
-            self.screen = SnackScreen()
-        else:
-            storage_pool = actions.storage.get_default_pool()
-            if storage_pool is None:
-                return display_info(self.screen, "Error", "Default storage pool is not defined!")
-            repos = actions.templates.get_template_repos()
-            if repos is None:
+            # templates can be queued also while a synchronisation is running
+            if self.display_sync_status(['Queue more', 'Back']) != 'queue more':
                 return self.display_templates()
-            chosen_repo = display_selection(self.screen, TITLE, repos, 'Please, select template repository from the list')
-            if chosen_repo is None:
-                return self.display_templates()
-            selected_list = self.display_select_template_from_repo(chosen_repo, storage_pool)
-            if selected_list is None:
-                return self.display_templates()
-            self.screen.finish()
-            try:
-                actions.templates.sync_storage_pool(storage_pool, chosen_repo, selected_list)
-            except TemplateException:
-                # here comes hack
-                self.screen = SnackScreen()
-                cleanup = ButtonChoiceWindow(self.screen, 'Existing task pool',
-                                               "A task pool is already defined. It could mean\nthat the previous " +
-                                               "synchronisation crashed, or that there is one working already.\n\n" +
-                                               "Would you like to force synchronisation?",
-                                                      ['Yes', 'No'])
-                self.screen.finish()
-                if cleanup == 'yes':
-                    actions.templates.sync_storage_pool(storage_pool, chosen_repo, selected_list, force=True)
-            self.screen = SnackScreen()
+        storage_pool = actions.storage.get_default_pool()
+        if storage_pool is None:
+            return display_info(self.screen, "Error", "Default storage pool is not defined!")
+        repos = actions.templates.get_template_repos()
+        if repos is None:
+            return self.display_templates()
+        chosen_repo = display_selection(self.screen, TITLE, repos, 'Please, select template repository from the list')
+        if chosen_repo is None:
+            return self.display_templates()
+        selected_list = self.display_select_template_from_repo(chosen_repo, storage_pool)
+        if selected_list is None:
+            return self.display_templates()
+        # deleting unselected templates prints to the console
+        self.screen.finish()
+        actions.templates.sync_storage_pool(storage_pool, chosen_repo, selected_list)
+        self.screen = SnackScreen()
         self.display_templates()
-        
-        
+
+    def display_sync_status(self, buttons=('Back',)):
+        """Display status of template synchronisation jobs"""
+        lines = []
+        for job in actions.templates.get_sync_status():
+            if job['state'] == 'running' and job['total']:
+                state = "%d%% of %.1f MB, %.0f KB/s" % (100 * job['done'] / job['total'],
+                                                       job['total'] / 1024.0 ** 2,
+                                                       (job.get('rate') or 0) / 1024.0)
+            elif job['state'] == 'failed':
+                state = "failed: %s" % job['error']
+            else:
+                state = job['state']
+            lines.append("%s (%s): %s" % (job['template'], job['storage_pool'], state))
+        return ButtonChoiceWindow(self.screen, 'Template synchronisation',
+                                  '\n'.join(lines) or 'No synchronisation jobs.',
+                                  list(buttons), width=70)
+
     def display_template_rename(self):
         if actions.templates.is_syncing():
-            self.screen.finish()
-            actions.utils.attach_screen('OPENNODE-SYNC')
-            self.screen = SnackScreen()
+            self.display_sync_status()
         else:
             storage_pool = actions.storage.get_default_pool()
             if storage_pool is None:
@@ -457,7 +459,8 @@ class OpenNodeTUI(object):
         available_vms = {}
         vms_labels = []
         for vmt in actions.vm.backends():
-            vms = actions.vm.list_vms(vmt)
+            vms = actions.vm.iter_vms(vmt, fields=['uuid', 'name', 'state', 'run_state',
+                                                   'vm_type', 'vm_uri'])
             for vm in vms:
                 available_vms[vm["uuid"]] = vm
                 vms_labels.append(("%s (%s) - %s" % (vm["name"], vm["run_state"],
@@ -515,6 +518,8 @@ class OpenNodeTUI(object):
         if action is None or action == 'edit':
             vm_type = available_vms[vm_id]['vm_type']
             vm = actions.vm.get_module(vm_type)
+            # the listing above holds only the summary fields
+            available_vms[vm_id] = actions.vm.info_vm(available_vms[vm_id]['vm_uri'], vm_id)
             if vm_type == 'openvz':
                 ctid = actions.vm.openvz.get_ctid_by_uuid(vm_id)
                 available_vms[vm_id]['onboot'] = actions.vm.openvz. \
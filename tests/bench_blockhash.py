@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Benchmark of the in-process block hashing of template files.
+
+Times computing a block hash manifest in a single streaming read, verifying a
+file against it with one and with several threads, and the pfff sampling hash
+when the pfff binary is installed. Runs on a generated file of the given size
+or on an existing file, e.g. a template tarball.
+
+Usage: bench_blockhash.py [-s GB] [-f FILE] [-w WORKERS] [-d DIR]
+"""
+
+import os
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+from opennode.cli.actions import blockhash
+from opennode.cli.actions.utils import execute, CommandException
+
+
+def generate(fnm, size):
+    """Write a file of incompressible, non-repeating blocks"""
+    pattern = os.urandom(blockhash.BLOCK_SIZE)
+    with open(fnm, 'wb') as f:
+        written, index = 0, 0
+        while written < size:
+            block = ('%016x' % index) + pattern[16:]
+            block = block[:size - written]
+            f.write(block)
+            written += len(block)
+            index += 1
+
+
+def timed(name, size, fun):
+    start = time.time()
+    res = fun()
+    elapsed = time.time() - start
+    print '%-22s %8.2f s %8.1f MB/s' % (name, elapsed, size / elapsed / 1024 ** 2)
+    return res
+
+
+def main():
+    parser = OptionParser(usage='%prog [-s GB] [-f FILE] [-w WORKERS] [-d DIR]')
+    parser.add_option('-s', '--size', type='float', default=4,
+                      help='size of the generated file in GB')
+    parser.add_option('-f', '--file', help='hash an existing file instead')
+    parser.add_option('-w', '--workers', type='int',
+                      default=os.sysconf('SC_NPROCESSORS_ONLN'))
+    parser.add_option('-d', '--dir', default=None,
+                      help='folder for the generated file')
+    options, args = parser.parse_args()
+
+    fnm = options.file
+    if fnm is None:
+        fd, fnm = tempfile.mkstemp(suffix='.tar', dir=options.dir)
+        os.close(fd)
+        size = int(options.size * 1024 ** 3)
+        timed('generate', size, lambda: generate(fnm, size))
+    size = os.path.getsize(fnm)
+    print '%s: %.2f GB, %s workers (page cache not dropped)' % (
+        fnm, size / 1024.0 ** 3, options.workers)
+
+    try:
+        manifest = timed('compute', size, lambda: blockhash.compute(fnm))
+        ok = timed('verify, 1 thread', size, lambda: blockhash.verify(fnm, manifest, 1))
+        ok = timed('verify, %s threads' % options.workers, size,
+                   lambda: blockhash.verify(fnm, manifest, options.workers)) and ok
+        timed('valid_prefix', size, lambda: blockhash.valid_prefix(fnm, manifest,
+                                                                   options.workers))
+        if not ok:
+            print 'verification FAILED'
+            return 1
+        try:
+            timed('pfff', size, lambda: execute("pfff -k 6996807 -B %s" % fnm))
+        except CommandException:
+            print '%-22s not installed' % 'pfff'
+    finally:
+        if options.file is None:
+            os.unlink(fnm)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+Benchmark of the VM listing path against the libvirt test:/// driver.
+
+Defines a number of domains on test:///default and times the uncached listing
+path of vm.list_vms, counting the libvirt calls made per domain. For
+comparison the same domains are also walked the way the listing did before
+domain snapshots: three XML fetches and parses (console vnc, console pty,
+interfaces), two info() and several getType() calls per domain.
+
+Usage: bench_listing.py [-n DOMAINS] [-r ROUNDS]
+"""
+
+import sys
+import time
+from collections import defaultdict
+from optparse import OptionParser
+from xml.etree import ElementTree
+
+import libvirt
+
+from opennode.cli.actions import vm
+from opennode.cli.actions.vm.connection import pool
+
+
+URI = 'test:///default'
+
+DOMAIN_XML = """<domain type='test'>
+  <name>bench-%(n)d</name>
+  <memory>65536</memory>
+  <vcpu>1</vcpu>
+  <os><type>hvm</type></os>
+  <devices>
+    <interface type='network'>
+      <mac address='52:54:00:00:%(hi)02x:%(lo)02x'/>
+      <source network='default'/>
+    </interface>
+    <graphics type='vnc' port='%(port)d'/>
+    <console type='pty'/>
+  </devices>
+</domain>"""
+
+COUNTED = {libvirt.virConnect: ('getType', 'lookupByUUIDString', 'lookupByID', 'lookupByName'),
+           libvirt.virDomain: ('info', 'XMLDesc')}
+
+calls = defaultdict(int)
+
+
+def _count(cls, name):
+    method = getattr(cls, name)
+
+    def wrapper(self, *args, **kwargs):
+        calls[name] += 1
+        return method(self, *args, **kwargs)
+    setattr(cls, name, wrapper)
+
+
+def define_domains(conn, count):
+    existing = set(conn.listDefinedDomains())
+    existing.update(conn.lookupByID(i).name() for i in conn.listDomainsID())
+    for n in xrange(count):
+        if 'bench-%d' % n in existing:
+            continue
+        dom = conn.defineXML(DOMAIN_XML % dict(n=n, hi=n / 256, lo=n % 256,
+                                               port=5900 + n))
+        # half of the domains running, half only defined
+        if n % 2 == 0:
+            dom.create()
+
+
+def baseline_list(conn):
+    """Walk all domains with the per-VM call pattern the listing used to have"""
+    def tree(uuid):
+        return ElementTree.fromstring(conn.lookupByUUIDString(uuid).XMLDesc(0))
+
+    doms = [conn.lookupByID(i) for i in conn.listDomainsID()]
+    doms += [conn.lookupByName(i) for i in conn.listDefinedDomains()]
+    res = []
+    for dom in doms:
+        uuid = dom.UUIDString()
+        info = dom.info()
+        for i in range(7):
+            conn.getType()
+        vnc = tree(uuid).findall('.//graphics')
+        pty = tree(uuid).findall('.//console')
+        ifaces = tree(uuid).findall('.//interface')
+        res.append((uuid, dom.name(), info[1], dom.info()[3], vnc, pty, ifaces))
+    return res
+
+
+def measure(name, fun, rounds, domains):
+    calls.clear()
+    start = time.time()
+    for i in xrange(rounds):
+        fun()
+    elapsed = (time.time() - start) / rounds
+    per_vm = ', '.join('%s %.1f' % (k, float(v) / rounds / domains)
+                       for k, v in sorted(calls.items()))
+    print '%-10s %8.2f ms/listing  %6.3f ms/VM  calls per VM: %s' % (
+        name, elapsed * 1000, elapsed * 1000 / domains, per_vm)
+
+
+def main():
+    parser = OptionParser(usage='%prog [-n DOMAINS] [-r ROUNDS]')
+    parser.add_option('-n', '--domains', type='int', default=300)
+    parser.add_option('-r', '--rounds', type='int', default=5)
+    options, args = parser.parse_args()
+
+    conn = pool.get(URI)
+    define_domains(conn, options.domains)
+    domains = conn.numOfDomains() + conn.numOfDefinedDomains()
+    print 'listing %s domains of %s, %s rounds' % (domains, URI, options.rounds)
+
+    for cls, names in COUNTED.items():
+        for name in names:
+            _count(cls, name)
+
+    measure('baseline', lambda: baseline_list(conn), options.rounds, domains)
+    # the listing itself, bypassing the event driven inventory cache
+    measure('snapshots', lambda: vm._list_vms(conn), options.rounds, domains)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
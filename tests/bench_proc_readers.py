@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of the host metric readers used by OpenNode.metrics.
+
+Compares the per-call cost of the shell pipelines the func module used to run
+with the in-process /proc and statvfs readers of sysresources.
+
+Usage: bench_proc_readers.py [-i IFACE] [-n CALLS]
+"""
+
+import sys
+import time
+from optparse import OptionParser
+
+from opennode.cli.actions import sysresources as sysres
+from opennode.cli.actions.utils import execute
+
+
+def pipeline_readers(iface):
+    return [
+        ('cpu', lambda: map(int, execute("head -n 1 /proc/stat").split(' ')[2:6])),
+        ('load', lambda: float(execute("cat /proc/loadavg | awk '{print $1}'"))),
+        ('memory', lambda: float(execute("free | tail -n 2 | head -n 1 |awk '{print $3 / 1024}'"))),
+        ('network', lambda: [int(v) for v in execute("grep %s: /proc/net/dev | awk -F: '{print $2}' "
+                                                     "| awk '{print $1, $9}'" % iface).split(' ')]),
+        ('disk', lambda: float(execute("df -P |grep ' /$' | head -n 1 | awk '{print $3/1024}'"))),
+    ]
+
+
+def proc_readers(iface):
+    return [
+        ('cpu', sysres.get_cpu_times),
+        ('load', sysres.get_loadavg),
+        ('memory', sysres.get_memory_usage_mb),
+        ('network', lambda: sysres.get_netdev_counters(iface)),
+        ('disk', lambda: sysres.get_diskspace_usage_mb('/')),
+    ]
+
+
+def per_call(fun, calls):
+    start = time.time()
+    for i in xrange(calls):
+        fun()
+    return (time.time() - start) / calls
+
+
+def main():
+    parser = OptionParser(usage='%prog [-i IFACE] [-n CALLS]')
+    parser.add_option('-i', '--iface', default='lo')
+    parser.add_option('-n', '--calls', type='int', default=200)
+    options, args = parser.parse_args()
+
+    old = pipeline_readers(options.iface)
+    new = proc_readers(options.iface)
+    print '%-8s %14s %15s %8s' % ('metric', 'pipeline (us)', 'in-process (us)', 'speedup')
+    total_old = total_new = 0
+    for (name, old_fun), (_, new_fun) in zip(old, new):
+        t_old = per_call(old_fun, options.calls)
+        t_new = per_call(new_fun, options.calls)
+        total_old += t_old
+        total_new += t_new
+        print '%-8s %14.1f %15.1f %7.0fx' % (name, t_old * 1e6, t_new * 1e6, t_old / t_new)
+    print '%-8s %14.1f %15.1f %7.0fx' % ('all', total_old * 1e6, total_new * 1e6,
+                                         total_old / total_new)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
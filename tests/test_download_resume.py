@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""
+Tests of resumable downloads (utils.download) against a local HTTP server
+which cuts responses short on purpose.
+
+Run standalone: python tests/test_download_resume.py
+"""
+
+import BaseHTTPServer
+import base64
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import urllib2
+
+from opennode.cli.actions import utils
+
+
+DATA = os.urandom(1000000)
+CREDENTIALS = ('user', 'secret')
+
+
+class FlakyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves DATA at /file with Range support, requiring basic auth. The first
+    server.cuts responses are closed after server.cut_after bytes."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        if self.headers.get('Authorization') != 'Basic ' + base64.b64encode('%s:%s' % CREDENTIALS):
+            self.send_response(401)
+            self.send_header('WWW-Authenticate', 'Basic realm="templates"')
+            return self.end_headers()
+        if self.path != '/file':
+            self.send_response(404)
+            return self.end_headers()
+
+        byte_range = self.headers.get('Range')
+        server.ranges.append(byte_range)
+        start = 0
+        if byte_range and server.ranges_supported:
+            start = int(byte_range.split('=')[1].rstrip('-'))
+            if start >= len(DATA):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%s' % len(DATA))
+                return self.end_headers()
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, len(DATA) - 1, len(DATA)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(DATA) - start))
+        self.end_headers()
+
+        end = len(DATA)
+        if server.cuts > 0:
+            server.cuts -= 1
+            end = min(end, start + server.cut_after)
+        # the connection is closed once the handler returns
+        self.wfile.write(DATA[start:end])
+
+
+class DownloadResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), FlakyHandler)
+        self.server.ranges = []
+        self.server.ranges_supported = True
+        self.server.cuts = 0
+        self.server.cut_after = 300000
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+        self.url = 'http://%s:%s@127.0.0.1:%s/file' % (CREDENTIALS + (self.server.server_port,))
+        self.tmpdir = tempfile.mkdtemp()
+        self.local = os.path.join(self.tmpdir, 'template.tar')
+        self.partfile = self.local + '.part'
+
+        # no backoff between retries
+        self._sleep = utils.time.sleep
+        utils.time.sleep = lambda seconds: None
+
+    def tearDown(self):
+        utils.time.sleep = self._sleep
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def download(self, **kwargs):
+        progress = []
+        utils.download(self.url, self.local,
+                       lambda count, size, total: progress.append((size, total)), **kwargs)
+        return progress
+
+    def assertDownloaded(self):
+        self.assertFalse(os.path.exists(self.partfile))
+        self.assertEqual(open(self.local, 'rb').read(), DATA)
+
+    def test_complete(self):
+        progress = self.download()
+        self.assertDownloaded()
+        self.assertEqual(self.server.ranges, [None])
+        self.assertEqual(progress[-1], (len(DATA), len(DATA)))
+
+    def test_resume_after_dropped_connections(self):
+        self.server.cuts = 3
+        progress = self.download(verify=lambda fnm: open(fnm, 'rb').read() == DATA)
+        self.assertDownloaded()
+        self.assertEqual(self.server.ranges,
+                         [None, 'bytes=300000-', 'bytes=600000-', 'bytes=900000-'])
+        self.assertEqual(progress[-1], (len(DATA), len(DATA)))
+
+    def test_resume_across_calls(self):
+        self.server.cuts = 1
+        self.assertRaises(IOError, self.download, retries=0)
+        self.assertFalse(os.path.exists(self.local))
+        self.assertEqual(os.path.getsize(self.partfile), 300000)
+
+        self.download()
+        self.assertDownloaded()
+        self.assertEqual(self.server.ranges, [None, 'bytes=300000-'])
+
+    def test_complete_partfile(self):
+        open(self.partfile, 'wb').write(DATA)
+        self.download()
+        self.assertDownloaded()
+        self.assertEqual(self.server.ranges, ['bytes=%s-' % len(DATA)])
+
+    def test_stale_partfile_is_discarded(self):
+        open(self.partfile, 'wb').write('x' * 500000)
+        self.download(verify=lambda fnm: open(fnm, 'rb').read() == DATA)
+        self.assertDownloaded()
+        self.assertEqual(self.server.ranges, ['bytes=500000-', None])
+
+    def test_verify_failure(self):
+        self.assertRaises(IOError, self.download, verify=lambda fnm: False)
+        self.assertFalse(os.path.exists(self.local))
+        self.assertFalse(os.path.exists(self.partfile))
+
+    def test_server_without_ranges(self):
+        self.server.ranges_supported = False
+        self.server.cuts = 2
+        self.download()
+        self.assertDownloaded()
+        self.assertEqual(len(self.server.ranges), 3)
+
+    def test_missing_file_is_not_retried(self):
+        self.url = self.url.replace('/file', '/missing')
+        self.assertRaises(urllib2.HTTPError, self.download)
+        self.assertEqual(self.server.ranges, [])
+
+
+if __name__ == '__main__':
+    unittest.main()